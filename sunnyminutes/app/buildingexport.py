@@ -0,0 +1,100 @@
+# buildingexport module, to export the Manhattan_buildings tables to a building store
+
+import re
+import sqlite3
+
+from buildingmapping import get_buildings_from_rows
+from buildingstore import make_building_store
+
+CITY_NAME = 'New York Manhattan'
+GRID_ID = 1
+EXPORTED_TABLES = ['Cities', 'Grids', 'Blocks', 'Nodes']
+
+
+# reads the Cities, Grids, Blocks and Nodes tables through a database connection
+# (MySQL, or SQLite with the same schema) and makes a BuildingStore of them
+def export_building_store(db_connection):
+    with db_connection:
+        cur = db_connection.cursor()
+        cur.execute("SELECT \
+            Planet_radius, \
+            Mean_lon, \
+            Mean_lat \
+            FROM Cities \
+            WHERE Name = '" + CITY_NAME + "'\
+        ")
+        city = cur.fetchall()[0]
+
+        cur = db_connection.cursor()
+        cur.execute("SELECT \
+            Xmin,\
+            Xmax,\
+            Xstep,\
+            Ymin,\
+            Ymax,\
+            Ystep\
+            FROM Grids \
+            WHERE Id = " + str(GRID_ID)
+        )
+        grid = cur.fetchall()[0]
+
+        cur = db_connection.cursor()
+        cur.execute("SELECT \
+            Nodes.X,\
+            Nodes.Y,\
+            Nodes.Z, \
+            Nodes.Order_in_building,\
+            Nodes.Number_of_nodes_in_building,\
+            Nodes.Building_id, \
+            Blocks.X_id, \
+            Blocks.Y_id \
+            FROM Nodes \
+            JOIN Blocks ON Nodes.Block_id = Blocks.Id \
+            WHERE Nodes.Z > 0 \
+            ORDER BY Nodes.Building_id, Nodes.Order_in_building\
+        ")
+        buildings = get_buildings_from_rows(cur)
+
+    rows = []
+    for (building_id, building) in buildings.iteritems():
+        rows.append((building_id, building.x, building.y, building.z,
+            building.block[0], building.block[1]))
+
+    return make_building_store(rows,
+        [float(value) for value in grid], [float(value) for value in city])
+
+
+# loads the exported tables of a mysqldump file into an in-memory SQLite database; only
+# the column names of the CREATE TABLE statements and the INSERT statements are used
+def load_sql_dump(path, tables=EXPORTED_TABLES):
+    db_connection = sqlite3.connect(':memory:')
+
+    table = None
+    columns = []
+    f = open(path, 'r')
+    for line in f:
+        # columns of a table definition
+        if table is not None:
+            match = re.match(r'\s+`(\w+)`', line)
+            if match:
+                columns.append(match.group(1))
+            elif line.startswith(')'):
+                if table in tables:
+                    db_connection.execute('CREATE TABLE ' + table + ' (' + ', '.join(columns) + ')')
+                table = None
+            continue
+
+        match = re.match(r'CREATE TABLE `(\w+)`', line)
+        if match:
+            table = match.group(1)
+            columns = []
+            continue
+
+        # mysqldump escapes quotes with backslashes, SQLite by doubling them
+        match = re.match(r'INSERT INTO `(\w+)` VALUES ', line)
+        if match and match.group(1) in tables:
+            db_connection.execute(line.strip().rstrip(';').replace("\\'", "''"))
+    f.close()
+
+    db_connection.commit()
+    return db_connection
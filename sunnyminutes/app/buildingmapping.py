@@ -6,6 +6,13 @@ matplotlib.use('Agg')
 from matplotlib.patches import Polygon
 from matplotlib.collections import PatchCollection
 
+from skyline import HorizonRaster
+from buildingstore import BuildingStore
+from dbpool import get_placeholder
+
+FAR_FIELD_RING_RADIUS = 3 # blocks around the observer's block represented by proxies
+METERS_PER_FLOOR = 3
+
 # class to store a single node of a building
 class Node:
     def __init__(self, input_x=0, input_y=0):
@@ -30,12 +37,24 @@ class Node:
 
 
 
-# class to store geometries of a single building
-class Building:
-    def __init__(self):
-        self.nodes = []   # list of Nodes
+# class to store geometries of a single building, with its nodes as arrays of coordinates
+class Building(object):
+    def __init__(self, x=(), y=(), z=None, block=None):
+        self.x = np.array(x, dtype=float)   # x coordinates of the nodes
+        self.y = np.array(y, dtype=float)   # y coordinates of the nodes
         self.center = Node()
-        self.z = None        # height
+        self.z = z        # height
+        self.block = block  # (X_id, Y_id) of its block
+
+    # list of Nodes (a copy, changing them does not change the building)
+    @property
+    def nodes(self):
+        return [Node(x, y) for (x, y) in zip(self.x.tolist(), self.y.tolist())]
+
+    @nodes.setter
+    def nodes(self, nodes):
+        self.x = np.array([node.x for node in nodes], dtype=float)
+        self.y = np.array([node.y for node in nodes], dtype=float)
         
     def show(self):
         print 'Nodes:'
@@ -48,48 +67,22 @@ class Building:
     def plot_footprint(self, ax, color='k'):
         gray_color = '#909090'
         
-        x_list = []
-        y_list = []
-        for node in self.nodes[:-1]:
-            x_list.append(node.x)
-            y_list.append(node.y)
-        
-        x_arr = np.array([x_list])
-        y_arr = np.array([y_list])
-
-        xy = np.concatenate((x_arr.T, y_arr.T), axis=1)
+        xy = np.column_stack((self.x[:-1], self.y[:-1]))
         poly = Polygon(xy)
         p = PatchCollection([poly], facecolor=color, edgecolor=gray_color)
         ax.add_collection(p)
 
     def calculate_center(self):
-        x_array = []
-        y_array = []
-        for node in self.nodes:
-            x_array.append(node.x)
-            y_array.append(node.y)
-        self.center.x = np.mean(x_array)
-        self.center.y = np.mean(y_array)
+        self.center.x = np.mean(self.x)
+        self.center.y = np.mean(self.y)
 
 
     # function to assign a building to a block, using its center coordinates
     def assign_to_block(self, building_id, x_grid, y_grid, blocks):
         
-        # find x_index of the block
-        block_x_index = -1
-        for x in x_grid:
-            if self.center.x > x:
-                block_x_index += 1
-            else:
-                break
-        
-        # find y_index of the block
-        block_y_index = -1
-        for y in y_grid:
-            if self.center.y > y:
-                block_y_index += 1
-            else:
-                break
+        # index of the last grid line below the center
+        block_x_index = int(np.searchsorted(x_grid, self.center.x, side='left')) - 1
+        block_y_index = int(np.searchsorted(y_grid, self.center.y, side='left')) - 1
                 
         # compile key (as string)
         block_key = str(block_x_index) + ':' + str(block_y_index)
@@ -98,56 +91,252 @@ class Building:
         blocks[block_key].building_ids.append(building_id)
                     
 
+    # planar geometry of the roofs seen from the observer's (x, y): for each roof, the
+    # distances of the two endpoints of its edge and its (phi1, phi2) range of azimuths
+    def get_roof_geometry(self, obs_x, obs_y, blur_epsilon=0.01):
+        offsets = np.array([0, len(self.x)])
+        return get_edge_roofs(offsets, self.x, self.y, obs_x, obs_y, blur_epsilon)[1:]
+
     # distills a list of roofs from nodes of a building, given the observer's location
     def get_roofs(self, obs_x, obs_y, obs_z, blur_epsilon=0.01):
-        
-        roofs = []
-        
-        # gather node coordinates
-        dx_list = []
-        dy_list = []
-        for node in self.nodes:
-            dx_list.append(node.x)
-            dy_list.append(node.y)
-        
-        # calculate relative location with respect to the observer
-        dx_list = np.array(dx_list) - obs_x
-        dy_list = np.array(dy_list) - obs_y
-        dz = self.z - obs_z
-        
-        # calclate distances from the observer
-        dist_list = np.sqrt(dx_list**2 + dy_list**2)
-     
-        # calculate viewing angles
-        theta_list = np.arctan( np.true_divide(dz, dist_list) )
-        phi_list = -np.arctan2(dx_list, -dy_list)
-        
+        (dist1, dist2, phi1, phi2) = self.get_roof_geometry(obs_x, obs_y, blur_epsilon)
+        theta = get_roof_elevations(self.z - obs_z, dist1, dist2)
+        return zip(phi1, phi2, theta)
 
-        for i in range(0, len(dx_list)-1):
-            # order the two endpoints in ascending order
-            phi1 = min(phi_list[i], phi_list[i+1])
-            phi2 = max(phi_list[i], phi_list[i+1])
-
-            # get visible height of the building
-            theta = np.mean(theta_list[i:i+2])
-            
-            # check if the building crosses the North line
-            if dy_list[i] > 0 and dy_list[i+1] > 0 and dx_list[i] * dx_list[i+1] < 0:
-                # if so, make two separate roof objects, on the two edges of the silhouette
-                roof1 = (-np.pi - blur_epsilon, phi1 + blur_epsilon, theta)
-                roof2 = (phi2 - blur_epsilon, np.pi + blur_epsilon, theta)
-                roofs.append(roof1)
-                roofs.append(roof2)
-                
-            # if not, make a single roof object
-            else:
-                roof = (phi1 - blur_epsilon, phi2 + blur_epsilon, theta)
-                roofs.append(roof)
-        
-        return roofs
 
 
 
+# flattens the buildings (given by their keys) into one table of nodes: the nodes of
+# building i are x[offsets[i]:offsets[i+1]] and y[offsets[i]:offsets[i+1]], its height z[i]
+def flatten_buildings(buildings, keys):
+    number_of_nodes = [len(buildings[key].x) for key in keys]
+    offsets = np.concatenate(([0], np.cumsum(number_of_nodes))).astype(int)
+    x = np.concatenate([buildings[key].x for key in keys] + [np.zeros(0)])
+    y = np.concatenate([buildings[key].y for key in keys] + [np.zeros(0)])
+    z = np.array([buildings[key].z for key in keys], dtype=float)
+    return (offsets, x, y, z)
+
+
+# planar geometry of the roofs on every edge of a table of nodes, seen from the observer's
+# (x, y), in one pass: the building index, the distances of the two endpoints of the edge 
+# and the (phi1, phi2) range of azimuths of each roof, grouped by building
+def get_edge_roofs(offsets, x, y, obs_x, obs_y, blur_epsilon=0.01):
+
+    # an edge starts at every node but the last one of each building
+    is_last = np.zeros(len(x), dtype=bool)
+    is_last[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = True
+    start = np.flatnonzero(~is_last)
+    edge_building = np.searchsorted(offsets, start, side='right') - 1
+
+    # node coordinates, relative to the observer
+    dx_arr = x - obs_x
+    dy_arr = y - obs_y
+    
+    # calclate distances from the observer
+    dist_arr = np.sqrt(dx_arr**2 + dy_arr**2)
+ 
+    # calculate viewing angles
+    phi_arr = -np.arctan2(dx_arr, -dy_arr)
+
+    # order the two endpoints of each edge in ascending order
+    phi1 = np.minimum(phi_arr[start], phi_arr[start + 1])
+    phi2 = np.maximum(phi_arr[start], phi_arr[start + 1])
+
+    # check which edges cross the North line
+    north = (dy_arr[start] > 0) & (dy_arr[start + 1] > 0) & \
+        (dx_arr[start] * dx_arr[start + 1] < 0)
+
+    # if so, make two separate roofs, on the two edges of the silhouette,
+    # if not, make a single roof (the second one is dropped)
+    roof_phi1 = np.column_stack((
+        np.where(north, -np.pi - blur_epsilon, phi1 - blur_epsilon), 
+        phi2 - blur_epsilon))
+    roof_phi2 = np.column_stack((
+        np.where(north, phi1 + blur_epsilon, phi2 + blur_epsilon), 
+        np.full_like(phi2, np.pi + blur_epsilon)))
+    keep = np.column_stack((np.ones(len(north), dtype=bool), north))
+    building = np.column_stack((edge_building, edge_building))
+    dist1 = np.column_stack((dist_arr[start], dist_arr[start]))
+    dist2 = np.column_stack((dist_arr[start + 1], dist_arr[start + 1]))
+
+    return (building[keep], dist1[keep], dist2[keep], roof_phi1[keep], roof_phi2[keep])
+
+
+# (point, building) index pairs for which the point (of arrays px, py) is inside the
+# polygon of the building (of a table of nodes, with the first node repeated as last), 
+# by the ray-casting rule of Observer.is_inside, for all the pairs at once
+def get_containing_polygons(px, py, offsets, x, y):
+    px = np.asarray(px, dtype=float)
+    py = np.asarray(py, dtype=float)
+    number_of_vertices = np.maximum(offsets[1:] - offsets[:-1] - 1, 0)
+    starts = offsets[:-1]
+
+    # bounding boxes of the polygons, as a prefilter
+    x_min = np.full(len(starts), np.inf)
+    x_max = np.full(len(starts), -np.inf)
+    y_min = np.full(len(starts), np.inf)
+    y_max = np.full(len(starts), -np.inf)
+    nonempty = number_of_vertices > 0
+    if nonempty.any():
+        x_min[nonempty] = np.minimum.reduceat(x, starts[nonempty])
+        x_max[nonempty] = np.maximum.reduceat(x, starts[nonempty])
+        y_min[nonempty] = np.minimum.reduceat(y, starts[nonempty])
+        y_max[nonempty] = np.maximum.reduceat(y, starts[nonempty])
+    in_box = (x_min <= px[:, None]) & (px[:, None] <= x_max) & \
+        (y_min <= py[:, None]) & (py[:, None] <= y_max)
+    (point_index, building_index) = np.nonzero(in_box)
+
+    # the edges of the candidate pairs, each polygon closed from its last vertex to the first
+    n = number_of_vertices[building_index]
+    pair = np.repeat(np.arange(0, len(point_index)), n)
+    k = np.arange(0, len(pair)) - np.repeat(np.cumsum(n) - n, n)
+    n = n[pair]
+    first = starts[building_index][pair]
+    p1x = x[first + k]
+    p1y = y[first + k]
+    p2x = x[first + (k + 1) % np.maximum(n, 1)]
+    p2y = y[first + (k + 1) % np.maximum(n, 1)]
+    x0 = px[point_index][pair]
+    y0 = py[point_index][pair]
+
+    # edges crossed by the ray from the point towards +x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xints = (y0 - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+        crossing = (y0 > np.minimum(p1y, p2y)) & (y0 <= np.maximum(p1y, p2y)) & \
+            (x0 <= np.maximum(p1x, p2x)) & ((p1x == p2x) | (x0 <= xints))
+
+    inside = np.bincount(pair[crossing], minlength=len(point_index)) % 2 == 1
+    return (point_index[inside], building_index[inside])
+
+
+# keys of the buildings (among keys) containing each of the points (px, py)
+def get_buildings_containing_points(buildings, keys, px, py):
+    keys = list(keys)
+    (offsets, x, y, z) = flatten_buildings(buildings, keys)
+    (point_index, building_index) = get_containing_polygons(px, py, offsets, x, y)
+
+    containing_keys = [[] for i in range(0, len(np.atleast_1d(px)))]
+    for (i, j) in zip(point_index.tolist(), building_index.tolist()):
+        containing_keys[i].append(keys[j])
+    return containing_keys
+
+
+# visible height of roofs of height dz, from the distances of their two endpoints
+def get_roof_elevations(dz, dist1, dist2):
+    with np.errstate(divide='ignore'):
+        theta1 = np.arctan( np.true_divide(dz, dist1) )
+        theta2 = np.arctan( np.true_divide(dz, dist2) )
+    return (theta1 + theta2) / 2
+
+
+# (phi1, phi2) azimuth ranges covering the bounding boxes of a table of nodes, as seen from
+# the observer: two per building, the second one is nan unless the building crosses the North line
+def get_azimuth_spans(offsets, x, y, obs_x, obs_y, blur_epsilon=0.01):
+    x_min = np.minimum.reduceat(x, offsets[:-1])
+    x_max = np.maximum.reduceat(x, offsets[:-1])
+    y_min = np.minimum.reduceat(y, offsets[:-1])
+    y_max = np.maximum.reduceat(y, offsets[:-1])
+
+    dx_arr = np.column_stack((x_min, x_min, x_max, x_max)) - obs_x
+    dy_arr = np.column_stack((y_min, y_max, y_min, y_max)) - obs_y
+    phi_arr = -np.arctan2(dx_arr, -dy_arr)
+
+    spans = np.empty((len(x_min), 2, 2))
+    spans[:, 0, 0] = phi_arr.min(axis=1) - blur_epsilon
+    spans[:, 0, 1] = phi_arr.max(axis=1) + blur_epsilon
+    spans[:, 1, :] = np.nan
+
+    # the building crosses the North line
+    north = (x_min < obs_x) & (obs_x < x_max) & (y_min > obs_y)
+    spans[north, 0, 0] = -np.pi - blur_epsilon
+    spans[north, 0, 1] = np.where(phi_arr < 0, phi_arr, -np.inf)[north].max(axis=1) + blur_epsilon
+    spans[north, 1, 0] = np.where(phi_arr > 0, phi_arr, np.inf)[north].min(axis=1) - blur_epsilon
+    spans[north, 1, 1] = np.pi + blur_epsilon
+
+    # the observer is within the bounding box
+    inside = (x_min <= obs_x) & (obs_x <= x_max) & (y_min <= obs_y) & (obs_y <= y_max)
+    spans[inside, 0, 0] = -np.pi - blur_epsilon
+    spans[inside, 0, 1] = np.pi + blur_epsilon
+    spans[inside, 1, :] = np.nan
+
+    # lower bound on the distances of the buildings from the observer
+    dx = np.maximum(np.maximum(x_min - obs_x, 0), obs_x - x_max)
+    dy = np.maximum(np.maximum(y_min - obs_y, 0), obs_y - y_max)
+    distance_bound = np.sqrt(dx**2 + dy**2)
+
+    return (spans, distance_bound)
+
+
+# class to store the planar geometry of the roofs of many buildings seen from a fixed
+# (x, y) point, so that the roofs can be recalculated for any height of the observer
+class RoofGeometry:
+    def __init__(self, buildings, keys, obs_x, obs_y, blur_epsilon=0.01):
+        self.obs_x = obs_x
+        self.obs_y = obs_y
+        self.blur_epsilon = blur_epsilon
+        self.keys = list(keys)
+
+        (offsets, x, y, self.z) = flatten_buildings(buildings, self.keys)
+
+        # per building
+        (self.spans, self.distance_bound) = get_azimuth_spans(
+            offsets, x, y, obs_x, obs_y, blur_epsilon)
+
+        # per roof, grouped by building: roofs of building i are offsets[i]:offsets[i+1]
+        (self.building_index, self.dist1, self.dist2, self.phi1, self.phi2) = \
+            get_edge_roofs(offsets, x, y, obs_x, obs_y, blur_epsilon)
+        self.offsets = np.searchsorted(
+            self.building_index, np.arange(0, len(self.keys) + 1), side='left')
+
+    def is_valid_for(self, obs_x, obs_y, keys):
+        return self.obs_x == obs_x and self.obs_y == obs_y and set(self.keys) == set(keys)
+
+    # array of (phi1, phi2, theta) roofs of the buildings taller than the observer,
+    # optionally skipping the buildings which are hidden behind nearer ones
+    def get_roofs(self, obs_z, cull=True):
+        theta = get_roof_elevations(
+            self.z[self.building_index] - obs_z, self.dist1, self.dist2)
+        roofs = np.column_stack((self.phi1, self.phi2, theta))
+
+        if not cull:
+            return roofs[self.z[self.building_index] > obs_z]
+
+        # order the buildings taller than the observer from near to far
+        taller = np.flatnonzero(self.z > obs_z)
+        taller = taller[np.argsort(self.distance_bound[taller], kind='mergesort')]
+
+        # lower bound of the horizon built so far
+        horizon = HorizonRaster()
+        theta_bound = np.arctan2(self.z - obs_z, self.distance_bound)
+
+        # first and last bins of the azimuth spans of the buildings
+        has_span = ~np.isnan(self.spans[:, :, 0])
+        span_bins = horizon.get_bin_indices(np.where(has_span[:, :, None], self.spans, 0))
+
+        visible = []
+        for i in taller:
+            hidden = True
+            for j in np.flatnonzero(has_span[i]):
+                (first_bin, last_bin) = span_bins[i, j]
+                if horizon.theta[first_bin:last_bin + 1].min() < theta_bound[i]:
+                    hidden = False
+            if hidden:
+                continue
+
+            building_roofs = slice(self.offsets[i], self.offsets[i+1])
+            horizon.add_roofs(roofs[building_roofs], inner=True)
+            visible.append(np.arange(self.offsets[i], self.offsets[i+1]))
+
+        return roofs[np.concatenate(visible + [np.zeros(0, dtype=int)])]
+
+
+# number of floors of the highest of the given buildings (by key)
+def get_number_of_floors(buildings, keys):
+    number_of_floors = 0
+    for key in keys:
+        number_of_floors = max(number_of_floors, int(round(buildings[key].z * 1.0/METERS_PER_FLOOR)))
+    return number_of_floors
+
 
 # class for a block, haviing buildigns assigned to it
 class Block:
@@ -178,65 +367,158 @@ class Block:
         ax.plot(x_list, y_list)
 
 
-def append_buildings_in_block(db_connection, block_xid, block_yid):
-    with db_connection: 
-        cur = db_connection.cursor()
-        # get block_id
-        cur.execute("SELECT \
-            Id\
-            FROM Blocks\
-            WHERE X_id = " + str(block_xid) + "\
-                AND Y_id = " + str(block_yid) + "\
-        ")
-        result = cur.fetchall()
-        
-    # load nodes in the block into dict
-    buildings = {}
-    if result:
-        block_id = result[0][0]
-        
+# loads the extents and the height of the tallest building of every block of the city,
+# as a dict of Blocks by (X_id, Y_id)
+def load_block_proxies(db_connection):
+    if isinstance(db_connection, BuildingStore):
+        rows = zip(*[array.tolist() for array in db_connection.get_block_extents()])
+    else:
         with db_connection: 
             cur = db_connection.cursor()
             cur.execute("SELECT \
-                X,\
-                Y,\
-                Z, \
-                Order_in_building,\
-                Number_of_nodes_in_building,\
-                Building_id \
+                Blocks.X_id, \
+                Blocks.Y_id, \
+                MIN(Nodes.X), \
+                MAX(Nodes.X), \
+                MIN(Nodes.Y), \
+                MAX(Nodes.Y), \
+                MAX(Nodes.Z) \
                 FROM Nodes \
-                WHERE Block_id = " + str(block_id) + " \
-                    AND Z > 0 \
-                ORDER BY Building_id, Order_in_building\
+                JOIN Blocks ON Nodes.Block_id = Blocks.Id \
+                WHERE Nodes.Z > 0 \
+                GROUP BY Blocks.X_id, Blocks.Y_id\
             ")
             rows = cur.fetchall()
-        
-        i = 0
-        while i < len(rows):
-            
+
+    blocks = {}
+    for (block_xid, block_yid, x_min, x_max, y_min, y_max, max_z) in rows:
+        block = Block(Node(x_min, y_min), Node(x_max, y_min), Node(x_max, y_max), Node(x_min, y_max))
+        block.max_z = max_z
+        blocks[(block_xid, block_yid)] = block
+    return blocks
+
+
+# the Blocks in the rings around the observer's block, beyond the 3x3 blocks whose
+# buildings are loaded exactly, by (X_id, Y_id)
+def get_far_field_blocks(blocks, block_xid, block_yid, ring_radius=FAR_FIELD_RING_RADIUS):
+    far_field = {}
+    for dx in range(-ring_radius, ring_radius + 1):
+        for dy in range(-ring_radius, ring_radius + 1):
+            block = (block_xid + dx, block_yid + dy)
+            if max(abs(dx), abs(dy)) > 1 and block in blocks:
+                far_field[block] = blocks[block]
+    return far_field
+
+
+# array of (phi1, phi2, theta) roofs standing in for far-field blocks (a dict of Blocks):
+# one roof per block over the azimuths of its extents, as high as its tallest building
+# seen from the far end of the block; with a horizon (HorizonRaster), the blocks that
+# stay below it are pruned
+def get_block_proxy_roofs(blocks, obs_x, obs_y, obs_z, horizon=None, blur_epsilon=0.01):
+    blocks = [block for block in blocks.itervalues() if block.max_z > obs_z]
+    if not blocks:
+        return np.zeros((0, 3))
+
+    # the extents of the blocks as a table of nodes
+    offsets = np.arange(0, len(blocks) + 1) * 4
+    x = np.array([node.x for block in blocks for node in block.vertices], dtype=float)
+    y = np.array([node.y for block in blocks for node in block.vertices], dtype=float)
+    max_z = np.array([block.max_z for block in blocks], dtype=float)
+
+    (spans, distance_bound) = get_azimuth_spans(offsets, x, y, obs_x, obs_y, blur_epsilon)
+    far_distance = np.sqrt((x - obs_x)**2 + (y - obs_y)**2).reshape(-1, 4).max(axis=1)
+    theta = np.arctan2(max_z - obs_z, far_distance)
+
+    roofs = []
+    for i in range(0, len(blocks)):
+        for (phi1, phi2) in spans[i]:
+            if np.isnan(phi1):
+                continue
+            if horizon is None or horizon.get_min_elevation(phi1, phi2) < theta[i]:
+                roofs.append((phi1, phi2, theta[i]))
+    return np.array(roofs).reshape(-1, 3)
+
+
+def append_buildings_in_block(db_connection, block_xid, block_yid):
+    return load_buildings_in_blocks(db_connection, [block_xid], [block_yid])
+
+
+# loads the buildings of all the given blocks (lists of X_id and Y_id) in a single query,
+# or from a BuildingStore in place of the database connection
+def load_buildings_in_blocks(db_connection, block_xids, block_yids):
+    if isinstance(db_connection, BuildingStore):
+        return get_buildings_from_store(db_connection, block_xids, block_yids)
+
+    placeholder = get_placeholder(db_connection)
+    block_conditions = ' OR '.join(
+        ['(Blocks.X_id = ' + placeholder + ' AND Blocks.Y_id = ' + placeholder + ')'] * len(block_xids))
+    parameters = []
+    for (block_xid, block_yid) in zip(block_xids, block_yids):
+        parameters.extend([block_xid, block_yid])
+
+    with db_connection: 
+        cur = db_connection.cursor()
+        cur.execute("SELECT \
+            Nodes.X,\
+            Nodes.Y,\
+            Nodes.Z, \
+            Nodes.Order_in_building,\
+            Nodes.Number_of_nodes_in_building,\
+            Nodes.Building_id, \
+            Blocks.X_id, \
+            Blocks.Y_id \
+            FROM Nodes \
+            JOIN Blocks ON Nodes.Block_id = Blocks.Id \
+            WHERE (" + block_conditions + ") \
+                AND Nodes.Z > 0 \
+            ORDER BY Nodes.Building_id, Nodes.Order_in_building\
+        ", parameters)
+        buildings = get_buildings_from_rows(cur)
+
+    return buildings
+
+
+# collects the buildings on the given blocks from a BuildingStore, without database I/O
+def get_buildings_from_store(store, block_xids, block_yids):
+    buildings = {}
+    for i in store.get_building_indices(block_xids, block_yids):
+        (building_id, x, y, z, block_xid, block_yid) = store.get_building(i)
+        building = Building(x, y, z=z, block=(block_xid, block_yid))
+        building.calculate_center()
+        buildings[building_id] = building
+    return buildings
+
+
+# the buildings (dict by key) which are on the block (X_id, Y_id)
+def select_buildings_in_block(buildings, block_xid, block_yid):
+    return dict([(key, building) for (key, building) in buildings.iteritems() 
+        if building.block == (block_xid, block_yid)])
+
+
+# collects buildings from rows of (X, Y, Z, Order_in_building, Number_of_nodes_in_building,
+# Building_id, X_id, Y_id), ordered by building and node; a building starts at its node 
+# of order 1, and its height is taken from its last node
+def get_buildings_from_rows(rows):
+    buildings = {}
+    number_of_nodes_left = 0
+    for row in rows:
+        if number_of_nodes_left == 0:
             # find the first "1" in the Order_in_building column
-            if rows[i][3] == 1:
-                
-                building_id = rows[i][5]
-                building = Building()
-                
-                number_of_nodes = rows[i][4]
-                
-                # loop through the consecutive nodes
-                for j in range(0, number_of_nodes):
-                    i_cursor = i + j
-                    x = rows[i_cursor][0]
-                    y = rows[i_cursor][1]
-                    building.nodes.append(Node(x,y))
-                
-                z = rows[i_cursor][2]
-                building.z = z
-                building.calculate_center()
-                
-                buildings[building_id] = building
-                
-                i += number_of_nodes
-            else:
-                i += 1
+            if row[3] != 1:
+                continue
+            building_id = row[5]
+            number_of_nodes_left = row[4]
+            x_list = []
+            y_list = []
+
+        # the consecutive nodes
+        x_list.append(row[0])
+        y_list.append(row[1])
+        number_of_nodes_left -= 1
+
+        if number_of_nodes_left == 0:
+            building = Building(x_list, y_list, z=row[2], block=(row[6], row[7]))
+            building.calculate_center()
+            buildings[building_id] = building
 
     return buildings
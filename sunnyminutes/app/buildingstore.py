@@ -0,0 +1,160 @@
+# buildingstore module
+
+import os
+import json
+import hashlib
+import numpy as np
+
+BUILDING_STORE_FORMAT = 'sunnyminutes-building-store'
+BUILDING_STORE_VERSION = 1
+
+# arrays of the store, with their data types; the ones per node are indexed through
+# building_offsets, the ones per block through block_offsets (into the buildings,
+# which are ordered by block)
+BUILDING_STORE_ARRAYS = [
+    ('node_x', np.float32),
+    ('node_y', np.float32),
+    ('building_offsets', np.int64),
+    ('building_id', np.int64),
+    ('building_z', np.float32),
+    ('building_center_x', np.float32),
+    ('building_center_y', np.float32),
+    ('building_block_xid', np.int32),
+    ('building_block_yid', np.int32),
+    ('block_xid', np.int32),
+    ('block_yid', np.int32),
+    ('block_offsets', np.int64),
+    ]
+
+
+# class for a read-only store of the buildings of the city, as arrays in memory-mapped
+# .npy files, so that forked workers share the same pages
+class BuildingStore:
+
+    def __init__(self, arrays, grid, city):
+        self.arrays = arrays # name -> array
+        self.grid = grid  # (x_min, x_max, x_step, y_min, y_max, y_step)
+        self.city = city  # (planet_radius, mean_lon, mean_lat)
+
+        # index of the blocks: (X_id, Y_id) -> range of buildings
+        self.block_index = {}
+        block_offsets = arrays['block_offsets'].tolist()
+        for (i, block) in enumerate(zip(arrays['block_xid'].tolist(), arrays['block_yid'].tolist())):
+            self.block_index[block] = (block_offsets[i], block_offsets[i+1])
+
+    def get_number_of_buildings(self):
+        return len(self.arrays['building_id'])
+
+    # indices of the buildings on the given blocks (lists of X_id and Y_id)
+    def get_building_indices(self, block_xids, block_yids):
+        ranges = [self.block_index[block] for block in zip(block_xids, block_yids)
+            if block in self.block_index]
+        return np.concatenate([np.arange(start, stop) for (start, stop) in ranges]
+            + [np.zeros(0, dtype=int)])
+
+    # (building_id, x, y, z, block_xid, block_yid) of the building with the given index
+    def get_building(self, i):
+        a = self.arrays
+        nodes = slice(a['building_offsets'][i], a['building_offsets'][i+1])
+        return (int(a['building_id'][i]), a['node_x'][nodes], a['node_y'][nodes],
+            float(a['building_z'][i]), int(a['building_block_xid'][i]), int(a['building_block_yid'][i]))
+
+    # (X_id, Y_id, x_min, x_max, y_min, y_max, max_z) arrays of the blocks, from the
+    # extents of their buildings
+    def get_block_extents(self):
+        a = self.arrays
+        node_starts = a['building_offsets'][:-1]
+        building_starts = a['block_offsets'][:-1]
+        if len(node_starts) == 0:
+            return tuple([np.zeros(0)] * 7)
+
+        extents = []
+        for (coordinate, reduce_function) in [('node_x', np.minimum), ('node_x', np.maximum), 
+                ('node_y', np.minimum), ('node_y', np.maximum)]:
+            building_extent = reduce_function.reduceat(np.asarray(a[coordinate], dtype=float), node_starts)
+            extents.append(reduce_function.reduceat(building_extent, building_starts))
+        max_z = np.maximum.reduceat(np.asarray(a['building_z'], dtype=float), building_starts)
+
+        return (np.asarray(a['block_xid']), np.asarray(a['block_yid'])) + tuple(extents) + (max_z,)
+
+    # short hash of the buildings of the store, to tell apart the data derived from
+    # different stores
+    def get_fingerprint(self):
+        md5 = hashlib.md5()
+        for name in ['node_x', 'node_y', 'building_offsets', 'building_z']:
+            md5.update(np.ascontiguousarray(self.arrays[name]).tobytes())
+        return md5.hexdigest()[:12]
+
+    def save(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for (name, dtype) in BUILDING_STORE_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), np.asarray(self.arrays[name], dtype=dtype))
+        manifest = {
+            'format': BUILDING_STORE_FORMAT,
+            'version': BUILDING_STORE_VERSION,
+            'number_of_buildings': self.get_number_of_buildings(),
+            'number_of_nodes': len(self.arrays['node_x']),
+            'number_of_blocks': len(self.arrays['block_xid']),
+            'grid': dict(zip(['x_min', 'x_max', 'x_step', 'y_min', 'y_max', 'y_step'], self.grid)),
+            'city': dict(zip(['planet_radius', 'mean_lon', 'mean_lat'], self.city)),
+            'arrays': [name for (name, dtype) in BUILDING_STORE_ARRAYS],
+            }
+        f = open(os.path.join(path, 'manifest.json'), 'w')
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.close()
+
+
+# opens a store written by BuildingStore.save, memory-mapping its arrays
+def load_building_store(path, mmap_mode='r'):
+    f = open(os.path.join(path, 'manifest.json'), 'r')
+    manifest = json.load(f)
+    f.close()
+    if manifest.get('format') != BUILDING_STORE_FORMAT:
+        raise ValueError('not a building store: ' + path)
+    if manifest.get('version') != BUILDING_STORE_VERSION:
+        raise ValueError('unsupported building store version: ' + str(manifest.get('version')))
+
+    arrays = {}
+    for name in manifest['arrays']:
+        arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+
+    grid = manifest['grid']
+    city = manifest['city']
+    return BuildingStore(arrays,
+        (grid['x_min'], grid['x_max'], grid['x_step'], grid['y_min'], grid['y_max'], grid['y_step']),
+        (city['planet_radius'], city['mean_lon'], city['mean_lat']))
+
+
+# builds a store from lists of (building_id, x_list, y_list, z, block_xid, block_yid) tuples
+def make_building_store(buildings, grid, city):
+    # order the buildings by block, then by id
+    buildings = sorted(buildings, key=lambda b: (b[4], b[5], b[0]))
+
+    number_of_nodes = [len(b[1]) for b in buildings]
+    node_x = np.concatenate([np.asarray(b[1], dtype=float) for b in buildings] + [np.zeros(0)])
+    node_y = np.concatenate([np.asarray(b[2], dtype=float) for b in buildings] + [np.zeros(0)])
+    building_block_xid = np.array([b[4] for b in buildings], dtype=np.int32)
+    building_block_yid = np.array([b[5] for b in buildings], dtype=np.int32)
+    building_offsets = np.concatenate(([0], np.cumsum(number_of_nodes))).astype(np.int64)
+
+    # first building of each block
+    new_block = np.ones(len(buildings), dtype=bool)
+    new_block[1:] = (np.diff(building_block_xid) != 0) | (np.diff(building_block_yid) != 0)
+    block_starts = np.flatnonzero(new_block)
+
+    arrays = {
+        'node_x': node_x.astype(np.float32),
+        'node_y': node_y.astype(np.float32),
+        'building_offsets': building_offsets,
+        'building_id': np.array([b[0] for b in buildings], dtype=np.int64),
+        'building_z': np.array([b[3] for b in buildings], dtype=np.float32),
+        'building_center_x': np.array([np.mean(b[1]) for b in buildings], dtype=np.float32),
+        'building_center_y': np.array([np.mean(b[2]) for b in buildings], dtype=np.float32),
+        'building_block_xid': building_block_xid,
+        'building_block_yid': building_block_yid,
+        'block_xid': building_block_xid[block_starts],
+        'block_yid': building_block_yid[block_starts],
+        'block_offsets': np.append(block_starts, len(buildings)).astype(np.int64),
+        }
+    return BuildingStore(arrays, tuple(grid), tuple(city))
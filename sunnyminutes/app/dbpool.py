@@ -0,0 +1,167 @@
+# dbpool module
+
+import sys
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_POOL_SIZE = 4
+DB_POOL_TIMEOUT = 10 # seconds to wait for a free connection
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+# placeholder of the query parameters, from the paramstyle of the DB-API module of the
+# connection: '?' for sqlite3, '%s' for pymysql
+def get_placeholder(db_connection):
+    module = sys.modules.get(type(db_connection).__module__.split('.')[0])
+    if getattr(module, 'paramstyle', None) == 'qmark':
+        return '?'
+    return '%s'
+
+
+# connection to a SQLite file, for a pool: the pool hands a connection to one thread
+# at a time, but not always to the thread that made it, which sqlite3 refuses by default
+def connect_sqlite(path):
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+# checks that a connection still answers a trivial query
+def ping_connection(db_connection):
+    try:
+        cur = db_connection.cursor()
+        cur.execute('SELECT 1')
+        cur.fetchall()
+        return True
+    except Exception:
+        return False
+
+
+# class for a pool of at most size database connections, made by connect() when needed;
+# idle connections are health checked before being handed out again
+class ConnectionPool:
+
+    def __init__(self, connect, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, health_check=ping_connection):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.idle = [] # connections not in use
+        self.in_use = 0
+        self.lock = threading.Condition()
+
+        self.created = 0
+        self.discarded = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def checkout(self):
+        start_time = time.time()
+        self.lock.acquire()
+        try:
+            while True:
+                if self.idle:
+                    db_connection = self.idle.pop()
+                    break
+                if self.in_use + len(self.idle) < self.size:
+                    db_connection = None
+                    break
+                time_left = self.timeout - (time.time() - start_time)
+                if time_left <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError(
+                        'no free database connection in ' + str(self.timeout) + ' seconds')
+                self.lock.wait(time_left)
+            self.in_use += 1
+        finally:
+            self.lock.release()
+
+        # replace a broken idle connection, or make a new one
+        discarded = 0
+        created = 0
+        try:
+            if db_connection is not None and not self.health_check(db_connection):
+                close_connection(db_connection)
+                discarded = 1
+                db_connection = None
+            if db_connection is None:
+                db_connection = self.connect()
+                created = 1
+        except Exception:
+            self.release_slot()
+            raise
+
+        wait_time = time.time() - start_time
+        self.lock.acquire()
+        try:
+            self.discarded += discarded
+            self.created += created
+            self.checkouts += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        finally:
+            self.lock.release()
+        return db_connection
+
+    def checkin(self, db_connection):
+        self.lock.acquire()
+        try:
+            self.idle.append(db_connection)
+            self.in_use -= 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    # gives up the place of a connection that could not be made
+    def release_slot(self):
+        self.lock.acquire()
+        try:
+            self.in_use -= 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    # connection for the duration of a with block
+    @contextmanager
+    def connection(self):
+        db_connection = self.checkout()
+        try:
+            yield db_connection
+        finally:
+            self.checkin(db_connection)
+
+    # closes the idle connections
+    def close(self):
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for db_connection in idle:
+            close_connection(db_connection)
+
+    def get_stats(self):
+        return {
+            'size': self.size,
+            'in_use': self.in_use,
+            'idle': len(self.idle),
+            'created': self.created,
+            'discarded': self.discarded,
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time
+        }
+
+
+def close_connection(db_connection):
+    try:
+        db_connection.close()
+    except Exception:
+        pass
@@ -0,0 +1,163 @@
+# geocoding module
+
+import os
+import re
+import json
+from collections import OrderedDict
+
+GEOCODING_CACHE_SIZE = 10000
+GAZETTEER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.csv')
+
+# words dropped from the addresses (the app only knows Manhattan) and abbreviations
+ADDRESS_STOP_WORDS = ['manhattan', 'new york', 'new york city', 'nyc', 'ny', 'usa', 'us']
+ADDRESS_ABBREVIATIONS = [
+    ('street', 'st'),
+    ('avenue', 'ave'),
+    ('av', 'ave'),
+    ('boulevard', 'blvd'),
+    ('place', 'pl'),
+    ('square', 'sq'),
+    ('east', 'e'),
+    ('west', 'w'),
+    ('north', 'n'),
+    ('south', 's'),
+    ('first', '1'),
+    ('second', '2'),
+    ('third', '3'),
+    ('fourth', '4'),
+    ('fifth', '5'),
+    ('sixth', '6'),
+    ('seventh', '7'),
+    ('eighth', '8'),
+    ('ninth', '9'),
+    ('tenth', '10'),
+    ]
+
+
+# key of an address, the same for the usual spellings of the same address
+def normalize_address(address):
+    address = address.lower()
+    address = re.sub(r'[^a-z0-9,]+', ' ', address)
+
+    # drop the city and the country from the end
+    parts = [part.strip() for part in address.split(',')]
+    while len(parts) > 1 and (not parts[-1] or parts[-1] in ADDRESS_STOP_WORDS
+            or re.match(r'^(ny )?\d{5}$', parts[-1])):
+        parts.pop()
+
+    words = ' '.join(parts).split()
+    abbreviations = dict(ADDRESS_ABBREVIATIONS)
+    words = [abbreviations.get(word, word) for word in words]
+
+    # 42nd -> 42
+    words = [re.sub(r'^(\d+)(st|nd|rd|th)$', r'\1', word) for word in words]
+    return ' '.join(words)
+
+
+# asks Google for the coordinates of an address (needs network access)
+def google_provider(address):
+    import geocoder
+    latlng = geocoder.google(address).latlng
+    if latlng:
+        return (latlng[0], latlng[1])
+    return None
+
+
+# reads (address, lat, lon) lines of a gazetteer file into a dict by normalized address
+def load_gazetteer(path):
+    gazetteer = {}
+    f = open(path, 'r')
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        (address, lat, lon) = line.rsplit(',', 2)
+        gazetteer[normalize_address(address)] = (float(lat), float(lon))
+    f.close()
+    return gazetteer
+
+
+# class to look up the (lat, lon) of addresses: first among the most recently used ones,
+# then in the cache file (if given), then in the gazetteer, and at last by the provider;
+# the answers of the provider are kept in the cache file, to survive restarts
+class GeocodingCache:
+
+    def __init__(self, provider=google_provider, cache_file=None, gazetteer_file=GAZETTEER_FILE,
+            max_entries=GEOCODING_CACHE_SIZE):
+        self.provider = provider
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (lat, lon)
+        self.hits = 0
+        self.disk_hits = 0
+        self.gazetteer_hits = 0
+        self.provider_calls = 0
+        self.misses = 0
+
+        self.stored_entries = {}
+        if self.cache_file and os.path.exists(self.cache_file):
+            f = open(self.cache_file, 'r')
+            self.stored_entries = dict([(key, tuple(latlng)) for (key, latlng) in json.load(f).items()])
+            f.close()
+
+        self.gazetteer = {}
+        if gazetteer_file and os.path.exists(gazetteer_file):
+            self.gazetteer = load_gazetteer(gazetteer_file)
+
+    def geocode(self, address):
+        key = normalize_address(address)
+        if key in self.entries:
+            # mark as most recently used
+            latlng = self.entries.pop(key)
+            self.entries[key] = latlng
+            self.hits += 1
+            return latlng
+
+        if key in self.stored_entries:
+            latlng = self.stored_entries[key]
+            self.disk_hits += 1
+        elif key in self.gazetteer:
+            latlng = self.gazetteer[key]
+            self.gazetteer_hits += 1
+        else:
+            latlng = None
+            if self.provider:
+                self.provider_calls += 1
+                try:
+                    latlng = self.provider(address)
+                except Exception:
+                    latlng = None
+            if latlng is None:
+                self.misses += 1
+                return None
+            latlng = (float(latlng[0]), float(latlng[1]))
+            self.store(key, latlng)
+
+        self.entries[key] = latlng
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return latlng
+
+    # keeps an answer of the provider in the cache file
+    def store(self, key, latlng):
+        self.stored_entries[key] = latlng
+        if not self.cache_file:
+            return
+        temporary_file = self.cache_file + '.' + str(os.getpid()) + '.tmp'
+        f = open(temporary_file, 'w')
+        json.dump(self.stored_entries, f)
+        f.close()
+        os.rename(temporary_file, self.cache_file)
+
+    def get_stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'stored_entries': len(self.stored_entries),
+            'gazetteer_entries': len(self.gazetteer),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'gazetteer_hits': self.gazetteer_hits,
+            'provider_calls': self.provider_calls,
+            'misses': self.misses
+        }
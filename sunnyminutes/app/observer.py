@@ -3,9 +3,10 @@
 import re
 import numpy as np
 import datetime as dt
-import sympy.geometry as symg
 from dateutil.parser import parse
-import geocoder
+from buildingstore import BuildingStore
+from geocoding import google_provider
+from buildingmapping import get_buildings_containing_points
 
 import matplotlib
 matplotlib.use('Agg')
@@ -49,6 +50,10 @@ class Observer:
 
 
     def load_basic_geography(self, db_connection):
+        if isinstance(db_connection, BuildingStore):
+            (self.planet_radius, self.city_lon, self.city_lat) = db_connection.city
+            return
+
         with db_connection:
             cur = db_connection.cursor()
             cur.execute("SELECT \
@@ -63,13 +68,16 @@ class Observer:
         self.city_lon = result[1]
         self.city_lat = result[2]
 
-    def get_geocoordinates(self, address, floor):
+    def get_geocoordinates(self, address, floor, geocoding_cache=None):
         # if address:
         #     match = re.search(r'(-?\d+\.?\d*)\s*,?\s*(-?\d+\.?\d*)', address)
         #     if match:
         #         self.lat = float(match.group(1))
         #         self.lon = float(match.group(2))
-        geocoordinates_from_address = geocoder.google(address).latlng
+        if geocoding_cache:
+            geocoordinates_from_address = geocoding_cache.geocode(address)
+        else:
+            geocoordinates_from_address = google_provider(address)
         if geocoordinates_from_address:
             self.lat = geocoordinates_from_address[0]
             self.lon = geocoordinates_from_address[1]
@@ -102,41 +110,41 @@ class Observer:
         self.lon = self.city_lon + self.x / self.planet_radius / cos_mean_lat / deg2rad
         self.lat = self.city_lat + self.y / self.planet_radius / deg2rad
 
+    # (lat_min, lat_max, lon_min, lon_max) of the city covered by the grid of blocks
+    def get_city_extent(self, x_grid, y_grid):
+        deg2rad = np.pi/180
+        cos_mean_lat = np.cos(self.city_lat * deg2rad)
+        # the last grid lines are the lower edges of the last blocks
+        x_step = x_grid[1] - x_grid[0] if len(x_grid) > 1 else 0
+        y_step = y_grid[1] - y_grid[0] if len(y_grid) > 1 else 0
+        lon_min = self.city_lon + x_grid[0] / self.planet_radius / cos_mean_lat / deg2rad
+        lon_max = self.city_lon + (x_grid[-1] + x_step) / self.planet_radius / cos_mean_lat / deg2rad
+        lat_min = self.city_lat + y_grid[0] / self.planet_radius / deg2rad
+        lat_max = self.city_lat + (y_grid[-1] + y_step) / self.planet_radius / deg2rad
+        return (float(lat_min), float(lat_max), float(lon_min), float(lon_max))
+
     # finds the block the Node(x,y) coordinates are in
     # (blocks are indexed by (x_index, y_index), starting from (0,0) )
     def find_my_block(self, x_grid, y_grid):
-        # find x_index of the block
-        x_index = -1
-        for x in x_grid:
-            if self.x > x:
-                x_index += 1
-            else:
-                break
-        
-        # find y_index of the block
-        y_index = -1
-        for y in y_grid:
-            if self.y > y:
-                y_index += 1
-            else:
-                break
-        
-        self.block_xid = x_index
-        self.block_yid = y_index
+        # index of the last grid line below the observer
+        self.block_xid = int(np.searchsorted(x_grid, self.x, side='left')) - 1
+        self.block_yid = int(np.searchsorted(y_grid, self.y, side='left')) - 1
 
     def distance_from_building(self, building):
         dx = self.x - building.center.x
         dy = self.y - building.center.y
         return np.sqrt(dx**2 + dy**2)
 
-    def get_my_buildings(self, buildings):
-        my_building_keys = []
-        for key in buildings:
-            poly = []
-            for  node in buildings[key].nodes[:-1]:     # buildings repeat the first node as last
-                poly.append((node.x, node.y))
-            if self.is_inside(poly):
-                my_building_keys.append(key)
+    # keys of the buildings containing the observer; with a SpatialIndex, only the
+    # buildings whose bounding box contains the observer are tested
+    def get_my_buildings(self, buildings, spatial_index=None):
+        if spatial_index is None:
+            candidate_keys = list(buildings)
+        else:
+            candidate_keys = [key for key in spatial_index.get_candidates(self.x, self.y) if key in buildings]
+
+        my_building_keys = get_buildings_containing_points(
+            buildings, candidate_keys, [self.x], [self.y])[0]
 
         # z = 1e6
         # current_key = None
@@ -187,34 +195,32 @@ class Observer:
         self.closest_window = None
 
     def get_windows(self, building):
-        p_obs = symg.Point(self.x, self.y)
-
-        # collect the segments of the building
-        sides = []
-        for i in range(0, len(building.nodes)-1):
-            node1 = building.nodes[i]
-            node2 = building.nodes[i+1]
-            p1 = symg.Point(node1.x, node1.y)
-            p2 = symg.Point(node2.x, node2.y)
-            sides.append(symg.Segment(p1, p2))
+        # the segments of the building
+        x1 = building.x[:-1]
+        y1 = building.y[:-1]
+        vx = building.x[1:] - x1
+        vy = building.y[1:] - y1
+        length_squared = vx**2 + vy**2
+
+        # project the observer onto the lines of the segments (skipping zero-length ones)
+        nonzero = length_squared > 0
+        t = np.zeros(len(x1))
+        t[nonzero] = ((self.x - x1[nonzero]) * vx[nonzero] 
+            + (self.y - y1[nonzero]) * vy[nonzero]) / length_squared[nonzero]
 
         # collect windows that sit on the segments
-        for s in sides:
-            perp_line = s.perpendicular_line(p_obs)
-            p_list = symg.intersection(perp_line, s)
-            if p_list:
-                p_window = p_list[0]
-                phi = get_angle_from_south(p_obs, p_window)
-                distance = float(p_obs.distance(p_window))
-                w = Window(
-                    x=float(p_window.x), 
-                    y=float(p_window.y), 
-                    phi=phi, 
-                    distance=distance)
-                self.windows.append(w)
+        on_segment = nonzero & (t >= 0) & (t <= 1)
+        window_x = x1[on_segment] + t[on_segment] * vx[on_segment]
+        window_y = y1[on_segment] + t[on_segment] * vy[on_segment]
+        for (x, y) in zip(window_x.tolist(), window_y.tolist()):
+            w = Window(x=x, y=y)
+            w.phi = get_angle_from_south(self, w)
+            w.distance = float(np.sqrt((x - self.x)**2 + (y - self.y)**2))
+            self.windows.append(w)
 
         # find the closest window
-        self.closest_window = min(self.windows, key=lambda w: w.distance)
+        if self.windows:
+            self.closest_window = min(self.windows, key=lambda w: w.distance)
 
 
 
@@ -286,25 +292,29 @@ class Observer:
             ax.add_collection(p)
 
 
+# direction from p1 to p2 (anything with x and y), measured from South
 def get_angle_from_south(p1, p2):
     vx = float(p2.x - p1.x)
     vy = float(p2.y - p1.y)
     return np.arctan2(-vx, -vy) 
 
 def load_grid_data(db_connection):
-    with db_connection:
-        cur = db_connection.cursor()
-        cur.execute("SELECT \
-            Xmin,\
-            Xmax,\
-            Xstep,\
-            Ymin,\
-            Ymax,\
-            Ystep\
-            FROM Grids \
-            WHERE Id = 1"\
-        )
-        result = cur.fetchall()[0]
+    if isinstance(db_connection, BuildingStore):
+        result = db_connection.grid
+    else:
+        with db_connection:
+            cur = db_connection.cursor()
+            cur.execute("SELECT \
+                Xmin,\
+                Xmax,\
+                Xstep,\
+                Ymin,\
+                Ymax,\
+                Ystep\
+                FROM Grids \
+                WHERE Id = 1"\
+            )
+            result = cur.fetchall()[0]
 
     x_min = result[0]
     x_max = result[1]
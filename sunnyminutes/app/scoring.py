@@ -0,0 +1,155 @@
+# scoring module
+
+import numpy as np
+
+from buildingmapping import *
+from skyline import *
+from sun import *
+from observer import *
+from spatialindex import SpatialIndex
+
+SCORING_STEPSIZE = 5 # minutes between the positions of the Sun in the atlas
+
+# columns of the SunSummary returned for every observer
+SUMMARY_COLUMNS = ['total_sun', 'morning_sun', 'afternoon_sun', 'sunrise', 'sunset',
+    'wakinghours_sun', 'middayhours_sun']
+
+
+def get_sun_score(summary):
+    minutes_in_2h = 2*60
+    minutes_in_12h = 12*60
+    minutes_of_total_visible_sun = sum(summary.morning_sun)
+    minutes_of_total_visible_sun += sum(summary.afternoon_sun)
+    minutes_of_total_visible_sun /= len(summary.dates)
+    #minutes_of_waking_sun = sum(summary.wakinghours_sun)
+    #minutes_of_waking_sun /= len(summary.dates)
+    #wakeup_score = 100.0 * minutes_of_waking_sun / minutes_in_2h
+    day_score = 5.0 * minutes_of_total_visible_sun / minutes_in_12h
+    #sun_score = 0.5 * wakeup_score + 0.5 * day_score
+    #wakeup_score = round(wakeup_score, 1)
+    day_score = round(day_score, 1)
+    sun_score = day_score
+    #sun_score = round(sun_score, 1)
+    return sun_score
+
+
+def get_sky_score(sil):
+    sky_visibility = sil.calculate_sky_visibility()
+    sky_score = 5.0 * sky_visibility
+    sky_score = round(sky_score, 1)
+    return sky_score
+
+
+# the summary of the sunshine visible over the silhouette, from the exact segments of
+# the summary's dates; the views and score_observers both score through here, so that
+# they agree
+def collect_sun_summary(sil, observer, atlas=None):
+    summary = SunSummary()
+    summary.collect_exact_summary(sil, observer, atlas=atlas)
+    return summary
+
+
+# panorama seen from (x, y, z): the roofs of the given buildings, then the proxies of
+# the far-field blocks that are not hidden by them; the planar geometry is reused if
+# it is valid for the position and buildings, returns (panorama, geometry)
+def build_panorama(buildings, keys, far_field, x, y, z, geometry=None):
+    if geometry is None or not geometry.is_valid_for(x, y, keys):
+        geometry = RoofGeometry(buildings, keys, x, y)
+    roofs = geometry.get_roofs(z)
+    panorama = Silhouette()
+    panorama.add_roofs(roofs)
+
+    horizon = HorizonRaster()
+    horizon.add_roofs(roofs, inner=True)
+    panorama.add_roofs(get_block_proxy_roofs(far_field, x, y, z, horizon))
+    return (panorama, geometry)
+
+
+# scores a batch of observers, given as (lat, lon, floor) or (lat, lon, floor, phi_window)
+# tuples, phi_window being the direction the window faces (radians from South); without
+# it, the closest window of the building is taken. The observers are grouped by block,
+# so that the buildings of every 3x3 neighborhood are loaded once, and all share one
+# Sun atlas. Returns a dict per observer (in the given order) with the sun score, the
+# sky score and the columns of the SunSummary
+def score_observers(db_connection, observers, block_proxies=None, silhouette_cache=None,
+        stepsize=SCORING_STEPSIZE):
+    # geography of the city
+    city = Observer()
+    city.load_basic_geography(db_connection)
+    (x_grid, y_grid) = load_grid_data(db_connection)
+    if block_proxies is None:
+        block_proxies = load_block_proxies(db_connection)
+    atlas = get_sun_atlas(city.city_lat, city.city_lon, stepsize,
+        extent=city.get_city_extent(x_grid, y_grid))
+
+    # place the observers and group them by block
+    batch = []
+    groups = {}
+    for (i, observer) in enumerate(observers):
+        (lat, lon, floor) = observer[:3]
+        phi_window = None
+        if len(observer) > 3:
+            phi_window = observer[3]
+        obs = Observer(lon=lon, lat=lat, alt=float(floor) * METERS_PER_FLOOR,
+            city_lon=city.city_lon, city_lat=city.city_lat, planet_radius=city.planet_radius)
+        obs.convert_to_cartesian()
+        obs.find_my_block(x_grid, y_grid)
+        batch.append((obs, phi_window))
+        groups.setdefault((obs.block_xid, obs.block_yid), []).append(i)
+
+    results = [None] * len(batch)
+    for ((block_xid, block_yid), indices) in sorted(groups.items()):
+        # the buildings of the neighborhood and the proxies of the blocks beyond it
+        (x_id_list, y_id_list) = batch[indices[0]][0].get_neighboring_block_ids()
+        buildings = load_buildings_in_blocks(db_connection, x_id_list, y_id_list)
+        buildings_in_block = select_buildings_in_block(buildings, block_xid, block_yid)
+        spatial_index = SpatialIndex(buildings)
+        far_field = get_far_field_blocks(block_proxies, block_xid, block_yid)
+
+        # observers at the same place (on different floors) follow each other, so that
+        # they share the planar geometry
+        geometry = None
+        for i in sorted(indices, key=lambda i: (batch[i][0].x, batch[i][0].y)):
+            (obs, phi_window) = batch[i]
+            my_building_keys = obs.get_my_buildings(buildings_in_block, spatial_index)
+            if get_number_of_floors(buildings, my_building_keys) * METERS_PER_FLOOR > obs.z:
+                for key in my_building_keys:
+                    obs.get_windows(buildings[key])
+            if obs.closest_window:
+                (x, y) = (obs.closest_window.x, obs.closest_window.y)
+                if phi_window is None:
+                    phi_window = obs.closest_window.phi
+            else:
+                (x, y) = (obs.x, obs.y)
+
+            panorama = None
+            if silhouette_cache:
+                cache_key = silhouette_cache.get_key(x, y, obs.z)
+                panorama = silhouette_cache.get(cache_key)
+            if panorama is None:
+                keys = [key for key in buildings if key not in my_building_keys]
+                (panorama, geometry) = build_panorama(buildings, keys, far_field, x, y, obs.z, geometry)
+                if silhouette_cache:
+                    silhouette_cache.put(cache_key, panorama)
+
+            if phi_window is None:
+                sil = panorama
+            else:
+                sil = panorama.get_window_view(phi_window)
+            summary = collect_sun_summary(sil, obs, atlas=atlas)
+
+            result = {
+                'lat': obs.lat,
+                'lon': obs.lon,
+                'z': obs.z,
+                'block': (block_xid, block_yid),
+                'phi_window': phi_window,
+                'sun_score': get_sun_score(summary),
+                'sky_score': get_sky_score(sil),
+                'dates': summary.dates,
+                }
+            for column in SUMMARY_COLUMNS:
+                result[column] = getattr(summary, column)
+            results[i] = result
+
+    return results
@@ -1,5 +1,8 @@
 # skyline module
 
+import os
+import re
+from collections import OrderedDict
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -7,6 +10,12 @@ import matplotlib.pyplot as plt
 from matplotlib.patches import Wedge, Circle
 from matplotlib.collections import PatchCollection
 
+HORIZON_BINS = 3600 # number of azimuth bins of a horizon raster (0.1 degree each)
+SILHOUETTE_CACHE_SIZE = 1000 # maximum number of silhouettes kept in memory
+SILHOUETTE_CACHE_GRID = 1.0 # observer positions are rounded to this grid (meters)
+SILHOUETTE_CACHE_DISK_SIZE = 100000 # maximum number of silhouettes kept in cache_dir
+SILHOUETTE_CACHE_DISK_LOW_WATER = 0.9 # fraction of them kept after an eviction
+
 # class to store the geometry of a rooftop on the skyline
 class Roof:
     def __init__(self, tup=(-1, 1, -1)):
@@ -31,110 +40,296 @@ class Cliff:
     
 
 
-# class to store the skyline
-class Silhouette:
+# builds the skyline of roofs[lo:hi] by divide and conquer, as a list of (phi, theta)
+# key points, each setting the height of the skyline up to the next key point
+def build_skyline(roofs, lo, hi):
+    if hi - lo == 1:
+        (phi1, phi2, theta) = roofs[lo]
+        return [(phi1, theta), (phi2, 0)]
+    mid = (lo + hi) // 2
+    return merge_skylines(build_skyline(roofs, lo, mid), build_skyline(roofs, mid, hi))
+
+
+# merges two skylines into their upper envelope
+def merge_skylines(skyline1, skyline2):
+    merged = []
+    theta1 = 0
+    theta2 = 0
+    i = 0
+    j = 0
+    while i < len(skyline1) or j < len(skyline2):
+        if j == len(skyline2) or (i < len(skyline1) and skyline1[i][0] < skyline2[j][0]):
+            (phi, theta1) = skyline1[i]
+            i += 1
+        elif i == len(skyline1) or skyline2[j][0] < skyline1[i][0]:
+            (phi, theta2) = skyline2[j]
+            j += 1
+        else:
+            (phi, theta1) = skyline1[i]
+            theta2 = skyline2[j][1]
+            i += 1
+            j += 1
+        theta = max(theta1, theta2)
+
+        # a later key point at the same phi overrides the previous one
+        if merged and merged[-1][0] == phi:
+            merged.pop()
+        previous_theta = merged[-1][1] if merged else 0
+        if theta != previous_theta:
+            merged.append((phi, theta))
+    return merged
+
+
+# class to store the horizon as the highest obstruction in each of a fixed number of
+# azimuth bins, covering phi from -pi to pi; coarser than the silhouette, but cheap to
+# query, to merge and to store
+class HorizonRaster:
+
+    def __init__(self, number_of_bins=HORIZON_BINS):
+        self.number_of_bins = number_of_bins
+        self.theta = np.zeros(number_of_bins, dtype=np.float32)
+
+    def get_bin_indices(self, phi):
+        bin_index = np.floor((np.asarray(phi) + np.pi) / (2*np.pi) * self.number_of_bins)
+        return np.clip(bin_index, 0, self.number_of_bins - 1).astype(int)
+
+    # raises the bins touched by the roofs, given as (phi1, phi2, theta) rows or Roofs;
+    # with inner=True only the bins entirely covered by a roof are raised, which keeps
+    # the raster below the exact silhouette everywhere
+    def add_roofs(self, roofs, inner=False):
+        roofs = [(r.phi1, r.phi2, r.theta) if isinstance(r, Roof) else r for r in roofs]
+        roofs = np.asarray(roofs, dtype=float).reshape(-1, 3)
+        if inner:
+            bin_width = 2*np.pi / self.number_of_bins
+            first_bin = np.ceil((roofs[:, 0] + np.pi) / bin_width).astype(int)
+            last_bin = np.floor((roofs[:, 1] + np.pi) / bin_width).astype(int) - 1
+            first_bin = np.maximum(first_bin, 0)
+            last_bin = np.minimum(last_bin, self.number_of_bins - 1)
+        else:
+            first_bin = self.get_bin_indices(roofs[:, 0])
+            last_bin = self.get_bin_indices(roofs[:, 1])
+        number_of_bins = np.maximum(last_bin - first_bin + 1, 0)
+
+        # expand every roof into the list of its bins
+        roof_index = np.repeat(np.arange(0, len(roofs)), number_of_bins)
+        offsets = np.cumsum(number_of_bins) - number_of_bins
+        bin_index = first_bin[roof_index] + np.arange(0, len(roof_index)) - offsets[roof_index]
+        np.maximum.at(self.theta, bin_index, roofs[roof_index, 2].astype(np.float32))
+
+    def add_silhouette(self, sil):
+        self.add_roofs(np.column_stack((sil.phi[:-1], sil.phi[1:], sil.theta_R[:-1])))
+
+    # elementwise maximum with the other raster
+    def merge(self, other):
+        self.theta = np.maximum(self.theta, other.theta)
+
+    def get_elevation(self, phi):
+        return self.theta[self.get_bin_indices(phi)]
+
+    # lowest elevation of the bins touched by the azimuths between phi1 and phi2
+    def get_min_elevation(self, phi1, phi2):
+        first_bin = self.get_bin_indices(phi1)
+        last_bin = self.get_bin_indices(phi2)
+        return self.theta[first_bin:last_bin + 1].min()
+
+    def is_visible(self, phi, theta):
+        return self.theta[self.get_bin_indices(phi)] < theta
+
+    def calculate_sky_visibility(self):
+        deltaphi = 2*np.pi / self.number_of_bins
+        covered_sky = np.sum(deltaphi * np.sin(self.theta.astype(float)))
+        return (2*np.pi - covered_sky) / (2*np.pi)
+
+    # fixed size binary blob of the raster
+    def to_bytes(self):
+        return self.theta.tobytes()
+
+
+def load_horizon_raster(blob):
+    theta = np.frombuffer(blob, dtype=np.float32).copy()
+    raster = HorizonRaster(number_of_bins=len(theta))
+    raster.theta = theta
+    return raster
+
+
+# roofs at the zenith, covering the half of the sky behind a window facing phi_window
+def get_window_mask_roofs(phi_window):
+    if phi_window < -np.pi/2:
+        return [
+            Roof((phi_window + np.pi/2, phi_window - np.pi/2 + 2*np.pi, np.pi/2))
+            ]
+    elif phi_window > np.pi/2:
+        return [
+            Roof((phi_window + np.pi/2 -2*np.pi, phi_window - np.pi/2, np.pi/2))
+            ]
+    else:
+        return [
+            Roof((-np.pi, phi_window - np.pi/2, np.pi/2)), 
+            Roof((phi_window + np.pi/2, np.pi, np.pi/2))
+            ]
+
+
+# class to store the skyline, as parallel arrays of the cliffs' phi, theta_L and theta_R
+class Silhouette(object):
     
     def __init__(self):
-        self.cliffs = [] # list of cliffs ordered by phi
-        # add the two extreme points
-        self.cliffs.append(Cliff(-np.pi -1, 0,0))
-        self.cliffs.append(Cliff(np.pi + 1, 0,0))
-    
+        self.clear()
+
+    def copy(self):
+        sil = Silhouette()
+        sil.phi = self.phi.copy()
+        sil.theta_L = self.theta_L.copy()
+        sil.theta_R = self.theta_R.copy()
+        return sil
+
+    # the silhouette seen through a window facing phi_window: a copy of this (full
+    # panorama) silhouette, with the half of the sky behind the window covered
+    def get_window_view(self, phi_window):
+        sil = self.copy()
+        for roof in get_window_mask_roofs(phi_window):
+            sil.add_roof(roof)
+        return sil
+
+    def clear(self):
+        # the two extreme points
+        self.phi = np.array([-np.pi -1, np.pi + 1])
+        self.theta_L = np.array([0.0, 0.0])
+        self.theta_R = np.array([0.0, 0.0])
+
+    # list of cliffs ordered by phi (a copy, changing them does not change the silhouette)
+    @property
+    def cliffs(self):
+        return [Cliff(phi, theta_L, theta_R) 
+            for (phi, theta_L, theta_R) in zip(self.phi, self.theta_L, self.theta_R)]
+
+    @cliffs.setter
+    def cliffs(self, cliffs):
+        self.phi = np.array([cliff.phi for cliff in cliffs], dtype=float)
+        self.theta_L = np.array([cliff.theta_L for cliff in cliffs], dtype=float)
+        self.theta_R = np.array([cliff.theta_R for cliff in cliffs], dtype=float)
+
+    def insert_cliff(self, index, phi, theta_L, theta_R):
+        self.phi = np.insert(self.phi, index, phi)
+        self.theta_L = np.insert(self.theta_L, index, theta_L)
+        self.theta_R = np.insert(self.theta_R, index, theta_R)
+
+    # adds a single roof, rebuilding the arrays once; add_roofs is the path for many roofs
     def add_roof(self, roof):
+        H = roof.theta
+
         # find the cliffs that are between the roof's phi1 and phi2
-        cliffs_inside = []
-        insert_index_1 = 0
-        insert_index_2 = 0
-
-        i = 0
-        while self.cliffs[i].phi < roof.phi1:
-            insert_index_1 += 1
-            insert_index_2 += 1
-            i += 1
-        while self.cliffs[i].phi < roof.phi2:
-            insert_index_2 += 1
-            i += 1
+        (insert_index_1, insert_index_2) = np.searchsorted(self.phi, [roof.phi1, roof.phi2], side='left')
             
         # in case the entire roof falls between too cliffs
-        if not self.cliffs[insert_index_1 : insert_index_2]:
+        if insert_index_1 == insert_index_2:
             # get the silhouette's height from previous cliff
-            theta = self.cliffs[insert_index_1 -1].theta_R
+            theta = self.theta_R[insert_index_1 -1]
             # add only if it's higher
-            if theta < roof.theta:
-                cliff1 = Cliff(roof.phi1, theta, roof.theta)
-                cliff2 = Cliff(roof.phi2, roof.theta, theta)
-                self.cliffs.insert(insert_index_1, cliff1)
-                insert_index_2 += 1 # the first insertion shift the index
-                self.cliffs.insert(insert_index_2, cliff2)
-                
-        # in case the roof spans over at least one cliff
-        else:
-            
-            # process the cliffs between the roof endpoints
-            cliffs_to_delete = []
-            for i in range(insert_index_1, insert_index_2):
-                L = self.cliffs[i].theta_L
-                R = self.cliffs[i].theta_R
-                H = roof.theta
-                
-                # if the cliff is under the roof, delete it
-                if L < H and R < H:
-                    cliffs_to_delete.insert(0,i)
-                
-                # if the cliff crosses the roof downwards, update it
-                elif L > H and R < H:
-                    self.cliffs[i].theta_R = roof.theta
-                
-                # if the cliff crosses the roof upwards, update it
-                elif L < H and R > H:
-                    self.cliffs[i].theta_L = roof.theta
+            if theta < H:
+                self.insert_cliff(insert_index_1, 
+                    [roof.phi1, roof.phi2], [theta, H], [H, theta])
+            return
                 
-                # if the cliff is above the roof, it shouldn't change
-            
-            # process the endpoints of the roof
-            theta1 = self.cliffs[insert_index_1 -1].theta_R
-            theta2 = self.cliffs[insert_index_2].theta_L
+        # in case the roof spans over at least one cliff:
+        # process the cliffs between the roof endpoints
+        inside = slice(insert_index_1, insert_index_2)
+        L = self.theta_L[inside]
+        R = self.theta_R[inside]
+        
+        # if the cliff is under the roof, delete it
+        kept = np.maximum(L, R) >= H
+        L = L[kept]
+        R = R[kept]
             
-            # add phi2 first
-            if theta2 < roof.theta:
-                cliff2 = Cliff(roof.phi2, roof.theta, theta2)
-                self.cliffs.insert(insert_index_2, cliff2)
+        # if the cliff crosses the roof downwards, update it
+        new_R = np.where((L > H) & (R < H), H, R)
             
-            # delete cliffs under the roof
-            for index in cliffs_to_delete:
-                self.cliffs.pop(index)
+        # if the cliff crosses the roof upwards, update it
+        new_L = np.where((L < H) & (R > H), H, L)
             
-            # add phi1 last
-            if theta1 < roof.theta:
-                cliff1 = Cliff(roof.phi1, theta1, roof.theta)
-                self.cliffs.insert(insert_index_1, cliff1)
- 
-    def calculate_sky_visibility(self):
-        deltaphi_list = []
-        theta_list = []
+        # if the cliff is above the roof, it shouldn't change
+        
+        # process the endpoints of the roof, adding them where they rise above the silhouette
+        theta1 = self.theta_R[insert_index_1 -1]
+        theta2 = self.theta_L[insert_index_2]
+        first = ([], [], [])
+        if theta1 < H:
+            first = ([roof.phi1], [theta1], [H])
+        last = ([], [], [])
+        if theta2 < H:
+            last = ([roof.phi2], [H], [theta2])
+
+        # rebuild the arrays at once
+        head = slice(0, insert_index_1)
+        tail = slice(insert_index_2, None)
+        self.phi = np.concatenate((self.phi[head], first[0], self.phi[inside][kept], last[0], self.phi[tail]))
+        self.theta_L = np.concatenate((self.theta_L[head], first[1], new_L, last[1], self.theta_L[tail]))
+        self.theta_R = np.concatenate((self.theta_R[head], first[2], new_R, last[2], self.theta_R[tail]))
+
+    # adds many roofs (tuples, Roofs or an array of (phi1, phi2, theta) rows) at once,
+    # merging their skyline with the current one
+    def add_roofs(self, roofs):
+        if isinstance(roofs, np.ndarray):
+            roofs = roofs.reshape(-1, 3)
+            # roofs of no width or below the horizon never show on the silhouette
+            roofs = roofs[(roofs[:, 0] < roofs[:, 1]) & (roofs[:, 2] > 0)]
+            tups = roofs.tolist()
+        else:
+            tups = []
+            for roof in roofs:
+                if isinstance(roof, Roof):
+                    roof = (roof.phi1, roof.phi2, roof.theta)
+                # roofs of no width or below the horizon never show on the silhouette
+                if roof[0] < roof[1] and roof[2] > 0:
+                    tups.append(roof)
+        if not tups:
+            return
+
+        # the current silhouette as a list of (phi, theta) key points
+        skyline = zip(self.phi[1:-1].tolist(), self.theta_R[1:-1].tolist())
+        skyline = merge_skylines(skyline, build_skyline(tups, 0, len(tups)))
+
+        # convert the key points back to cliffs, between the two extreme points
+        phis = np.array([self.phi[0]] + [phi for (phi, theta) in skyline] + [self.phi[-1]])
+        thetas = np.array([0.0] + [theta for (phi, theta) in skyline] + [0.0])
+        self.phi = phis
+        self.theta_L = np.concatenate(([0.0], thetas[:-1]))
+        self.theta_R = thetas
 
-        for i in range(0, len(self.cliffs)-1, 1):
-            deltaphi_list.append(self.cliffs[i+1].phi - self.cliffs[i].phi)
-            theta_list.append(self.cliffs[i].theta_R)
+    # height of the silhouette at the azimuths phi
+    def get_elevation(self, phi):
+        cliff_index = np.searchsorted(self.phi, phi, side='right') - 1
+        cliff_index = np.clip(cliff_index, 0, len(self.phi) - 1)
+        return self.theta_R[cliff_index]
 
-        deltaphi_arr = np.array(deltaphi_list)
-        theta_arr = np.array(theta_list)
+    # decides for arrays of positions (phi, theta) on the sky whether they are above the silhouette
+    def is_visible(self, phi, theta):
+        # index of the first cliff at or beyond each azimuth
+        cliff_index = np.searchsorted(self.phi, phi, side='left')
+        cliff_index = np.minimum(cliff_index, len(self.phi) - 1)
+
+        return self.theta_L[cliff_index] < theta
+
+    def calculate_sky_visibility(self):
+        deltaphi_arr = np.diff(self.phi)
+        theta_arr = self.theta_R[:-1]
 
         full_sky = 2*np.pi
-        covered_sky = sum(deltaphi_arr * np.sin(theta_arr))
+        covered_sky = np.sum(deltaphi_arr * np.sin(theta_arr))
         visible_sky = (full_sky - covered_sky) / full_sky
         return visible_sky
 
+    # (phi, theta) points of the outline of the silhouette, for plotting
+    def get_outline(self, deg=True):
+        phis = np.repeat(self.phi, 2)
+        thetas = np.column_stack((self.theta_L, self.theta_R)).ravel()
+        if deg:
+            return (phis * 180 / np.pi, thetas * 180 / np.pi)
+        return (phis, thetas)
+
     def draw(self, ax, color='k'):
             
-        # colelect (phi, theta) from cliffs
-        phi_list = []
-        theta_list = []
-        for cliff in self.cliffs:
-            phi_list.append(cliff.phi * 180 / np.pi )
-            theta_list.append(cliff.theta_L * 180 / np.pi)
-            phi_list.append(cliff.phi * 180 / np.pi )
-            theta_list.append(cliff.theta_R * 180 / np.pi)
+        (phi_list, theta_list) = self.get_outline(deg=True)
 
         ax.fill_between(phi_list, 0, theta_list, color=color, facecolor=color)
 
@@ -164,23 +359,10 @@ class Silhouette:
         ax.add_collection(p)
 
         # get (phi, theta) coordinates from cliffs
-        phis = []
-        thetas = []
-        for cliff in self.cliffs:
-            phis.append(cliff.phi)
-            thetas.append(cliff.theta_L) 
-            phis.append(cliff.phi)
-            thetas.append(cliff.theta_R) 
-        phis = np.array(phis)
-        thetas = np.array(thetas)
+        (phi_deg, thetas) = self.get_outline(deg=False)
         
         # get rid of points out of bounds
-        phi_deg = phis * 180/np.pi
-        for i in range(0, len(phi_deg)):
-            if phi_deg[i] < -180:
-                phi_deg[i] = -180
-            if phi_deg[i] > 180:
-                phi_deg[i] = 180
+        phi_deg = np.clip(phi_deg * 180/np.pi, -180, 180)
 
         # declare wedges, corresponding to the buildings
         wedge_list = []
@@ -248,3 +430,138 @@ class Silhouette:
         ax.set_aspect('equal')
 
 
+
+# class to store the full panoramas by the observer's position and floor height (the
+# windows are masked at query time); the least recently used ones are evicted beyond
+# max_entries, and they are also written to cache_dir (if given) to survive restarts.
+# The files are kept in a subdirectory per version, which should name the data and the
+# settings the panoramas were built with, so that a restart with other ones does not
+# read stale panoramas. cache_dir may be shared by processes: the files are written
+# atomically, and when a process counts more than max_disk_entries files (from its
+# last scan of the directory and its own writes since) it scans the directory again
+# and removes the least recently used ones, down to SILHOUETTE_CACHE_DISK_LOW_WATER
+class SilhouetteCache:
+
+    def __init__(self, max_entries=SILHOUETTE_CACHE_SIZE, grid=SILHOUETTE_CACHE_GRID, cache_dir=None,
+            version='', max_disk_entries=SILHOUETTE_CACHE_DISK_SIZE):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.grid = grid
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict() # key -> (phi, theta_L, theta_R)
+        self.disk_entries = 0 # number of files in cache_dir, as far as this process knows
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_errors = 0
+        self.disk_evictions = 0
+        if self.cache_dir:
+            self.cache_dir = os.path.join(self.cache_dir, 'v_' + re.sub(r'[^A-Za-z0-9_.-]', '_', version))
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.disk_entries = len(self.get_file_names())
+
+    def get_key(self, x, y, z):
+        return (int(round(x / self.grid)), int(round(y / self.grid)), int(round(z * 10)))
+
+    def get_file_name(self, key):
+        return os.path.join(self.cache_dir, 'sil_' + '_'.join([str(k) for k in key]) + '.npz')
+
+    # the silhouette files in cache_dir (written by any process)
+    def get_file_names(self):
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+            if name.startswith('sil_') and name.endswith('.npz')]
+
+    # returns a copy of the cached silhouette, or None
+    def get(self, key):
+        if key in self.entries:
+            # mark as most recently used
+            arrays = self.entries.pop(key)
+            self.entries[key] = arrays
+            self.hits += 1
+        elif self.cache_dir and os.path.exists(self.get_file_name(key)):
+            arrays = self.load(key)
+            if arrays is None:
+                self.misses += 1
+                return None
+            self.store(key, arrays)
+            self.hits += 1
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            return None
+
+        sil = Silhouette()
+        (sil.phi, sil.theta_L, sil.theta_R) = [arr.copy() for arr in arrays]
+        return sil
+
+    # reads the arrays of a silhouette from cache_dir; a file that cannot be read is
+    # removed and taken as a miss
+    def load(self, key):
+        file_name = self.get_file_name(key)
+        try:
+            with np.load(file_name) as data:
+                arrays = (data['phi'], data['theta_L'], data['theta_R'])
+            # mark as recently used, for the eviction by any process
+            os.utime(file_name, None)
+            return arrays
+        except Exception:
+            self.disk_errors += 1
+            self.remove(file_name)
+            return None
+
+    def put(self, key, sil):
+        arrays = (sil.phi.copy(), sil.theta_L.copy(), sil.theta_R.copy())
+        self.store(key, arrays)
+        if self.cache_dir:
+            # write to a temporary file, so that other processes never read a partial one
+            file_name = self.get_file_name(key)
+            temporary_file = file_name + '.' + str(os.getpid()) + '.tmp'
+            f = open(temporary_file, 'wb')
+            np.savez(f, phi=arrays[0], theta_L=arrays[1], theta_R=arrays[2])
+            f.close()
+            os.rename(temporary_file, file_name)
+            self.disk_entries += 1
+            if self.disk_entries > self.max_disk_entries:
+                self.evict_files()
+
+    # removes the least recently used files of cache_dir, down to the low water mark
+    def evict_files(self):
+        file_names = []
+        for file_name in self.get_file_names():
+            try:
+                file_names.append((os.path.getmtime(file_name), file_name))
+            except OSError:
+                pass # removed by another process
+        file_names.sort()
+        number_to_keep = int(self.max_disk_entries * SILHOUETTE_CACHE_DISK_LOW_WATER)
+        number_to_remove = max(len(file_names) - number_to_keep, 0)
+        for (mtime, file_name) in file_names[:number_to_remove]:
+            self.remove(file_name)
+            self.disk_evictions += 1
+        self.disk_entries = len(file_names) - number_to_remove
+
+    def remove(self, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass # removed by another process
+
+    def store(self, key, arrays):
+        self.entries.pop(key, None)
+        self.entries[key] = arrays
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        return {
+            'entries': len(self.entries), 
+            'max_entries': self.max_entries, 
+            'hits': self.hits, 
+            'disk_hits': self.disk_hits, 
+            'disk_entries': self.disk_entries, 
+            'max_disk_entries': self.max_disk_entries, 
+            'disk_evictions': self.disk_evictions, 
+            'disk_errors': self.disk_errors, 
+            'misses': self.misses
+        }
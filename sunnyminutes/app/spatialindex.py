@@ -0,0 +1,95 @@
+# spatialindex module
+
+import numpy as np
+
+from buildingmapping import flatten_buildings
+
+SPATIAL_INDEX_CELL_SIZE = 50.0 # meters
+
+
+# class for a uniform grid over the bounding boxes of buildings: every cell lists the
+# buildings whose bounding box touches it, so that point and radius queries only look
+# at the buildings of a few cells
+class SpatialIndex:
+
+    def __init__(self, buildings, cell_size=SPATIAL_INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self.keys = list(buildings)
+
+        # bounding boxes and centers of the buildings
+        (offsets, x, y, z) = flatten_buildings(buildings, self.keys)
+        nonempty = offsets[1:] > offsets[:-1]
+        self.x_min = np.full(len(self.keys), np.inf)
+        self.x_max = np.full(len(self.keys), -np.inf)
+        self.y_min = np.full(len(self.keys), np.inf)
+        self.y_max = np.full(len(self.keys), -np.inf)
+        if nonempty.any():
+            starts = offsets[:-1][nonempty]
+            self.x_min[nonempty] = np.minimum.reduceat(x, starts)
+            self.x_max[nonempty] = np.maximum.reduceat(x, starts)
+            self.y_min[nonempty] = np.minimum.reduceat(y, starts)
+            self.y_max[nonempty] = np.maximum.reduceat(y, starts)
+        self.center_x = np.array([buildings[key].center.x for key in self.keys], dtype=float)
+        self.center_y = np.array([buildings[key].center.y for key in self.keys], dtype=float)
+
+        # extent of the grid
+        if nonempty.any():
+            self.x0 = self.x_min[nonempty].min()
+            self.y0 = self.y_min[nonempty].min()
+            self.nx = int((self.x_max[nonempty].max() - self.x0) // cell_size) + 1
+            self.ny = int((self.y_max[nonempty].max() - self.y0) // cell_size) + 1
+        else:
+            (self.x0, self.y0, self.nx, self.ny) = (0.0, 0.0, 1, 1)
+
+        # (cell, building) pairs for every cell touched by a bounding box
+        indices = np.flatnonzero(nonempty)
+        (ix1, iy1) = self.get_cell_indices(self.x_min[indices], self.y_min[indices])
+        (ix2, iy2) = self.get_cell_indices(self.x_max[indices], self.y_max[indices])
+        width = ix2 - ix1 + 1
+        height = iy2 - iy1 + 1
+        number_of_cells = width * height
+        building = np.repeat(indices, number_of_cells)
+
+        # running index of the pair within its building, unravelled into cell indices
+        first_pair = np.repeat(np.cumsum(number_of_cells) - number_of_cells, number_of_cells)
+        k = np.arange(0, len(building)) - first_pair
+        width = np.repeat(width, number_of_cells)
+        cell_x = np.repeat(ix1, number_of_cells) + k % width
+        cell_y = np.repeat(iy1, number_of_cells) + k // width
+        cell = cell_x * self.ny + cell_y
+
+        # buildings of cell i are cell_buildings[cell_offsets[i]:cell_offsets[i+1]]
+        order = np.argsort(cell, kind='mergesort')
+        self.cell_buildings = building[order]
+        self.cell_offsets = np.searchsorted(cell[order], np.arange(0, self.nx * self.ny + 1))
+
+    def get_cell_indices(self, x, y):
+        ix = np.clip(np.floor((np.asarray(x) - self.x0) / self.cell_size), 0, self.nx - 1).astype(int)
+        iy = np.clip(np.floor((np.asarray(y) - self.y0) / self.cell_size), 0, self.ny - 1).astype(int)
+        return (ix, iy)
+
+    # indices of the buildings listed in the cells of the range [ix1, ix2] x [iy1, iy2]
+    def get_buildings_in_cells(self, ix1, ix2, iy1, iy2):
+        slices = []
+        for ix in range(ix1, ix2 + 1):
+            first_cell = ix * self.ny + iy1
+            last_cell = ix * self.ny + iy2
+            slices.append(self.cell_buildings[self.cell_offsets[first_cell]:self.cell_offsets[last_cell + 1]])
+        return np.unique(np.concatenate(slices))
+
+    # keys of the buildings whose bounding box contains the point (x, y); these are the
+    # only candidates for buildings containing the point
+    def get_candidates(self, x, y):
+        (ix, iy) = self.get_cell_indices(x, y)
+        indices = self.get_buildings_in_cells(ix, ix, iy, iy)
+        inside = (self.x_min[indices] <= x) & (x <= self.x_max[indices]) & \
+            (self.y_min[indices] <= y) & (y <= self.y_max[indices])
+        return [self.keys[i] for i in indices[inside]]
+
+    # keys of the buildings whose center is closer to the point (x, y) than radius
+    def get_within_radius(self, x, y, radius):
+        (ix1, iy1) = self.get_cell_indices(x - radius, y - radius)
+        (ix2, iy2) = self.get_cell_indices(x + radius, y + radius)
+        indices = self.get_buildings_in_cells(ix1, ix2, iy1, iy2)
+        distance = np.sqrt((self.center_x[indices] - x)**2 + (self.center_y[indices] - y)**2)
+        return [self.keys[i] for i in indices[distance < radius]]
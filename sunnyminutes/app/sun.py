@@ -1,5 +1,6 @@
 # sun modul
 
+import os
 import numpy as np
 import datetime as dt
 from dateutil.parser import parse
@@ -8,13 +9,414 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 DURATION_OF_SUNRISE_SUNSET = 15 # minutes
+CITY_SPAN_DEG = 0.2 # extent of the city in latitude and longitude (degrees), if not given
+SUN_ATLAS_MAX_ERROR = 0.25 * np.pi/180 # largest error on the elevations taken from an atlas (radians)
+
+MINUTES_PER_DAY = 1440
+
+# number of set bits in each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(0, 256)], dtype=np.uint16)
+
+# sun atlases built in this process, keyed by (lat, lon, stepsize, year, extent)
+sun_atlases = {}
+
+
+# Sun's unit vectors (in equatorial coordinates) for a list of dates,
+# returned as an array of shape (number of dates, 3)
+def get_sun_vectors(dates):
+    start_date = dt.datetime(2000,1,1)
+
+    # the number of days from 1 Jan 2000
+    n = np.array([(d - start_date).days for d in dates])
+
+    # mean longitude of the Sun
+    L_deg = (280.460 + 0.9856474 * n) % 360
+
+    # mean anomaly of the Sun
+    g_deg = (357.528 + 0.9856003 * n) % 360
+    g_rad = g_deg * np.pi/180
+
+    # ecliptic longitude
+    lambda_deg = L_deg + 1.915 * np.sin(g_rad) + 0.020 * np.sin(2*g_rad)
+    lambda_rad = lambda_deg * np.pi/180
+
+    # obliquity of the ecliptic
+    eps_deg = 23.439 - 0.0000004 * n
+    eps_rad = eps_deg * np.pi/180
+
+    u_sun = np.array([
+                np.cos(lambda_rad),
+                np.cos(eps_rad) * np.sin(lambda_rad),
+                np.sin(eps_rad) * np.sin(lambda_rad)
+            ])
+    return u_sun.T
+
+
+# calculates the (azimuth, elevation) of the Sun for an array of greenwich times,
+# seen from the city at (lat, lon); u_sun[..., 0:3] is broadcast against the times
+def calculate_sun_positions(u_sun, lat, lon, time_minutes):
+    deg2rad = np.pi/180
+    minute2deg = 360.0/1440.0
+
+    theta_city_rad = (90 - lat) * deg2rad
+    phi_city_rad = (np.asarray(time_minutes) * minute2deg + lon) * deg2rad
+    cos_phi_city = np.cos(phi_city_rad)
+    sin_phi_city = np.sin(phi_city_rad)
+
+    u_sun = np.asarray(u_sun)
+    sun_x = u_sun[..., 0]
+    sun_y = u_sun[..., 1]
+    sun_z = u_sun[..., 2]
+
+    # components of the Sun's unit vector along the city's u_r, u_theta and u_phi
+    sun_xy = sun_x * cos_phi_city + sun_y * sin_phi_city
+    sun_r = np.sin(theta_city_rad) * sun_xy + np.cos(theta_city_rad) * sun_z
+    sun_theta = np.cos(theta_city_rad) * sun_xy - np.sin(theta_city_rad) * sun_z
+    sun_phi = -sun_x * sin_phi_city + sun_y * cos_phi_city
+
+    # height of the Sun on the sky
+    theta = np.pi/2 - np.arccos(np.clip(sun_r, -1, 1))
+
+    # azimuth of the Sun (measured from South, negative towards East)
+    phi = -np.arctan2(sun_phi, sun_theta)
+
+    return (phi, theta)
+
+
+# calculates the Sun's positions for every (date, time step) sample in one go;
+# returns (dates x steps) arrays with each row ordered by azimuth, the samples
+# below the horizon moved to the end of the row and marked False in daytime
+def calculate_sun_matrix(dates, lat, lon, stepsize):
+    times = np.arange(0, 1440, stepsize)
+    u_sun = get_sun_vectors(dates)
+    (phi, theta) = calculate_sun_positions(u_sun[:, np.newaxis, :], lat, lon, times)
+    daytime = theta > 0
+
+    # order the positions of each day by azimuth, night-time last
+    order = np.argsort(np.where(daytime, phi, np.inf), axis=1, kind='mergesort')
+    rows = np.arange(len(dates))[:, np.newaxis]
+    times = np.tile(times, (len(dates), 1))
+
+    return (times[rows, order], phi[rows, order], theta[rows, order], daytime[rows, order])
+
+
+# evaluates the visibility of every daytime position of a sun matrix against the silhouette
+def calculate_visibility_matrix(sil, phi, theta, daytime):
+    return sil.is_visible(phi, theta) & daytime
+
+
+# splits the daylight of each date into segments, at the hour angles where the Sun
+# passes the azimuth of a cliff or the elevation of a plateau of the silhouette, so
+# that the visibility of the Sun is constant within every segment;
+# returns (dates x segments) arrays of start and stop times (minutes from solar noon,
+# unused segments are empty) and visibility, the minutes of daylight on each date
+# and the greenwich time of solar noon (minutes)
+def calculate_sun_segments(dates, lat, lon, sil, u_sun=None):
+    deg2rad = np.pi/180
+    minute2rad = 2*np.pi/1440
+
+    if u_sun is None:
+        u_sun = get_sun_vectors(dates)
+    theta_city_rad = (90 - lat) * deg2rad
+
+    # the Sun's position as a function of the hour angle H:
+    #   sin(theta) = a * cos(H) + b
+    #   phi = arctan2(R * sin(H), c * cos(H) - d)
+    R = np.sqrt(u_sun[:, 0]**2 + u_sun[:, 1]**2)[:, np.newaxis]
+    a = np.sin(theta_city_rad) * R
+    b = np.cos(theta_city_rad) * u_sun[:, 2][:, np.newaxis]
+    c = np.cos(theta_city_rad) * R
+    d = np.sin(theta_city_rad) * u_sun[:, 2][:, np.newaxis]
+
+    def get_theta(H):
+        return np.arcsin(np.clip(a * np.cos(H) + b, -1, 1))
+
+    def get_phi(H):
+        return np.arctan2(R * np.sin(H), c * np.cos(H) - d)
+
+    def wrap(angle):
+        return (angle + np.pi) % (2*np.pi) - np.pi
+
+    # the Sun is above the horizon for -H0 < H < H0
+    H0 = np.arccos(np.clip(-b / a, -1, 1))
+
+    cliff_phis = sil.phi
+    plateau_thetas = sil.theta_R[:-1]
+
+    # hour angles where the Sun's azimuth equals a cliff's azimuth:
+    # solve R cos(phi) sin(H) - c sin(phi) cos(H) = -d sin(phi), and keep
+    # the one of the two roots that is not pointing to the opposite azimuth
+    A = R * np.cos(cliff_phis)
+    B = -c * np.sin(cliff_phis)
+    E = -d * np.sin(cliff_phis)
+    gamma = np.arctan2(B, A)
+    root = np.arcsin(np.clip(E / np.sqrt(A**2 + B**2), -1, 1))
+    H1 = wrap(root - gamma)
+    H2 = wrap(np.pi - root - gamma)
+    miss1 = np.abs(wrap(get_phi(H1) - cliff_phis))
+    miss2 = np.abs(wrap(get_phi(H2) - cliff_phis))
+    cliff_H = np.where(miss1 < miss2, H1, H2)
+    cliff_H[(np.abs(cliff_phis) > np.pi) | (np.abs(cliff_H) >= H0)] = np.nan
+
+    # hour angles where the Sun's elevation equals a plateau's elevation,
+    # kept only if the Sun is above that plateau at the time
+    cos_H = (np.sin(plateau_thetas) - b) / a
+    plateau_H = np.arccos(np.where(np.abs(cos_H) <= 1, cos_H, np.nan))
+    plateau_H = np.concatenate((-plateau_H, plateau_H), axis=1)
+    plateau_phi = get_phi(plateau_H)
+    left_phis = np.tile(cliff_phis[:-1], 2)
+    right_phis = np.tile(cliff_phis[1:], 2)
+    with np.errstate(invalid='ignore'):
+        plateau_H[(plateau_phi < left_phis) | (plateau_phi > right_phis)] = np.nan
+
+    # sort all breakpoints of each date, unused ones (nan) go to the end
+    breakpoints = np.concatenate((-H0, H0, cliff_H, plateau_H), axis=1)
+    breakpoints = np.sort(breakpoints, axis=1)
+    start = breakpoints[:, :-1]
+    stop = breakpoints[:, 1:]
+    used = ~np.isnan(stop)
+    start = np.where(used, start, 0)
+    stop = np.where(used, stop, 0)
+
+    # the visibility is decided in the middle of each segment
+    middle = (start + stop) / 2
+    visible = used & (stop > start) & sil.is_visible(get_phi(middle), get_theta(middle))
+
+    # solar noon in greenwich time
+    delta = np.arctan2(u_sun[:, 1], u_sun[:, 0])
+    noon = ((delta - lon * deg2rad) / minute2rad) % 1440
+
+    return (start / minute2rad, stop / minute2rad, visible, 2 * H0[:, 0] / minute2rad, noon)
+
+
+# minutes of visible segments falling between window_start and window_stop on each date
+def get_visible_minutes(start, stop, visible, window_start, window_stop):
+    window_start = np.reshape(window_start, (-1, 1))
+    window_stop = np.reshape(window_stop, (-1, 1))
+    overlap = np.minimum(stop, window_stop) - np.maximum(start, window_start)
+    return np.where(visible, np.maximum(overlap, 0), 0).sum(axis=1)
+
+
+# merges consecutive visible segments into a list of (start, stop) intervals for each date
+def merge_visible_segments(start, stop, visible):
+    intervals = []
+    for row in range(0, start.shape[0]):
+        day_intervals = []
+        for col in np.flatnonzero(visible[row]):
+            if day_intervals and day_intervals[-1][1] == start[row, col]:
+                day_intervals[-1] = (day_intervals[-1][0], stop[row, col])
+            else:
+                day_intervals.append((start[row, col], stop[row, col]))
+        intervals.append(day_intervals)
+    return intervals
+
+
+# mask of the columns selected by the python slice [start:stop] of every row,
+# where each row holds n[row] elements (negative bounds count from the row's end)
+def get_slice_mask(start, stop, n, number_of_columns):
+    start = np.where(start < 0, np.maximum(start + n, 0), np.minimum(start, n))
+    stop = np.where(stop < 0, np.maximum(stop + n, 0), np.minimum(stop, n))
+    cols = np.arange(number_of_columns)
+    return (cols >= start[:, np.newaxis]) & (cols < stop[:, np.newaxis])
+
+
+# table of the Sun's daily tracks over a city, keyed by day of the year and time step;
+# the positions are calculated at the center of the city, which puts an error of at
+# most max_error (radians) on the elevations anywhere within the extent of the city,
+# (lat_min, lat_max, lon_min, lon_max), by default CITY_SPAN_DEG around the center;
+# the Sun's unit vectors do not depend on the observer and hold everywhere
+class SunAtlas:
+    def __init__(self, lat=None, lon=None, stepsize=1, year=None, extent=None):
+        self.lat = lat
+        self.lon = lon
+        self.stepsize = stepsize
+        self.year = year
+        if self.year is None:
+            self.year = dt.datetime.today().year
+        self.extent = extent
+        if self.extent is None:
+            half_span = CITY_SPAN_DEG / 2.0
+            self.extent = (lat - half_span, lat + half_span, lon - half_span, lon + half_span)
+        self.max_error = 0
+        self.u_sun = None # (days x 3) array of the Sun's unit vectors
+        self.times = None # (days x steps) arrays, in the layout of calculate_sun_matrix
+        self.phi = None
+        self.theta = None
+        self.daytime = None
+
+    def calculate(self):
+        first_day = dt.datetime(self.year, 1, 1)
+        number_of_days = (dt.datetime(self.year + 1, 1, 1) - first_day).days
+        dates = [first_day + dt.timedelta(days=i) for i in range(0, number_of_days)]
+
+        self.u_sun = get_sun_vectors(dates)
+        (self.times, self.phi, self.theta, self.daytime) = \
+            calculate_sun_matrix(dates, self.lat, self.lon, self.stepsize)
+
+        # the elevation of the Sun changes at most by the angle between the zeniths,
+        # which is the largest at a corner of the extent
+        (lat_min, lat_max, lon_min, lon_max) = self.extent
+        self.max_error = max([self.get_error_bound(lat, lon) 
+            for lat in (lat_min, lat_max) for lon in (lon_min, lon_max)])
+
+    # upper bound on the error of the elevations for an observer at (lat, lon)
+    def get_error_bound(self, lat, lon):
+        deg2rad = np.pi/180
+        cos_angle = np.sin(self.lat * deg2rad) * np.sin(lat * deg2rad) \
+            + np.cos(self.lat * deg2rad) * np.cos(lat * deg2rad) * np.cos((lon - self.lon) * deg2rad)
+        return np.arccos(np.clip(cos_angle, -1, 1))
+
+    # whether the positions of the atlas are good enough for an observer at (lat, lon),
+    # i.e. within the extent and with an error bound below SUN_ATLAS_MAX_ERROR
+    def covers(self, lat, lon):
+        (lat_min, lat_max, lon_min, lon_max) = self.extent
+        return self.max_error <= SUN_ATLAS_MAX_ERROR \
+            and lat_min <= lat <= lat_max and lon_min <= lon <= lon_max
+
+    # rows of the atlas belonging to the dates (by day of the year)
+    def get_day_indices(self, dates):
+        indices = np.array([d.timetuple().tm_yday - 1 for d in dates])
+        return np.minimum(indices, len(self.u_sun) - 1)
+
+    def save(self, path):
+        np.savez(path, 
+            parameters=np.array([self.lat, self.lon, self.stepsize, self.year, self.max_error] 
+                + list(self.extent)),
+            u_sun=self.u_sun, times=self.times, phi=self.phi, theta=self.theta, daytime=self.daytime)
+
+
+def load_sun_atlas(path):
+    data = np.load(path)
+    (lat, lon, stepsize, year, max_error) = data['parameters'][:5]
+    extent = tuple(data['parameters'][5:].tolist())
+    atlas = SunAtlas(lat=lat, lon=lon, stepsize=int(stepsize), year=int(year), extent=extent)
+    atlas.max_error = max_error
+    atlas.u_sun = data['u_sun']
+    atlas.times = data['times']
+    atlas.phi = data['phi']
+    atlas.theta = data['theta']
+    atlas.daytime = data['daytime']
+    return atlas
+
+
+# key of an atlas in sun_atlases
+def get_sun_atlas_key(lat, lon, stepsize, year, extent):
+    if extent is not None:
+        extent = tuple([round(value, 4) for value in extent])
+    return (round(lat, 4), round(lon, 4), stepsize, year, extent)
+
+
+# returns the atlas of the city, building it (or loading it from path) on first use;
+# extent (lat_min, lat_max, lon_min, lon_max) is the area the error bound holds for
+def get_sun_atlas(lat, lon, stepsize, path=None, extent=None):
+    year = dt.datetime.today().year
+    key = get_sun_atlas_key(lat, lon, stepsize, year, extent)
+    if key not in sun_atlases:
+        # np.savez adds the extension if it is missing
+        if path and not path.endswith('.npz'):
+            path = path + '.npz'
+
+        atlas = None
+        if path and os.path.exists(path):
+            atlas = load_sun_atlas(path)
+            # without an extent, the one of the saved atlas is good enough
+            atlas_extent = None
+            if extent is not None:
+                atlas_extent = atlas.extent
+            if get_sun_atlas_key(atlas.lat, atlas.lon, atlas.stepsize, atlas.year, atlas_extent) != key:
+                atlas = None
+        if atlas is None:
+            atlas = SunAtlas(lat=lat, lon=lon, stepsize=stepsize, year=year, extent=extent)
+            atlas.calculate()
+            if path:
+                atlas.save(path)
+        sun_atlases[key] = atlas
+    return sun_atlases[key]
+
+
+# packed (days x minutes) bitset of the visible sunshine over a year; minutes are
+# counted in local solar time, i.e. solar noon falls on minute 720 of every day
+class VisibilityRaster:
+    def __init__(self, year=None):
+        self.year = year
+        if self.year is None:
+            self.year = dt.datetime.today().year
+        self.bits = None # (days x 180) array of packed bits
+        self.daylight = None # minutes of daylight on each day
+        self.noon = None # greenwich time of solar noon on each day (minutes)
+
+    def get_day_indices(self, dates):
+        indices = np.array([d.timetuple().tm_yday - 1 for d in dates])
+        return np.minimum(indices, len(self.bits) - 1)
+
+    # sets the bits of the minutes whose middle falls into a visible segment
+    def fill_from_segments(self, start, stop, visible, daylight, noon):
+        number_of_days = start.shape[0]
+        first_minute = np.ceil(start + MINUTES_PER_DAY/2 - 0.5).astype(int)
+        last_minute = np.ceil(stop + MINUTES_PER_DAY/2 - 0.5).astype(int)
+        first_minute = np.clip(first_minute, 0, MINUTES_PER_DAY)[visible]
+        last_minute = np.clip(last_minute, 0, MINUTES_PER_DAY)[visible]
+        rows = np.nonzero(visible)[0]
+
+        changes = np.zeros((number_of_days, MINUTES_PER_DAY + 1), dtype=int)
+        np.add.at(changes, (rows, first_minute), 1)
+        np.add.at(changes, (rows, last_minute), -1)
+        minutes = np.cumsum(changes, axis=1)[:, :-1] > 0
+
+        self.bits = np.packbits(minutes, axis=1)
+        self.daylight = np.asarray(daylight, dtype=np.float32)
+        self.noon = np.asarray(noon, dtype=np.float32)
+
+    # minutes of visible sunshine between the minutes start and stop (scalars or
+    # one value per row) on the given rows (days)
+    def count_minutes(self, start, stop, rows=None):
+        if rows is None:
+            rows = np.arange(0, len(self.bits))
+        minutes = np.arange(0, MINUTES_PER_DAY)
+        window = (minutes >= np.reshape(start, (-1, 1))) & (minutes < np.reshape(stop, (-1, 1)))
+        return POPCOUNT[self.bits[rows] & np.packbits(window, axis=1)].sum(axis=1)
+
+    # visibility of the Sun on the given rows (days) and minutes
+    def is_visible(self, rows, minutes):
+        minutes = np.asarray(minutes, dtype=int)
+        return (self.bits[rows, minutes >> 3] >> (7 - (minutes & 7))) & 1 == 1
+
+    def save(self, path):
+        np.savez(path, year=self.year, bits=self.bits, daylight=self.daylight, noon=self.noon)
+
+
+def load_visibility_raster(path):
+    data = np.load(path)
+    raster = VisibilityRaster(year=int(data['year']))
+    raster.bits = data['bits']
+    raster.daylight = data['daylight']
+    raster.noon = data['noon']
+    return raster
+
+
+# calculates the raster of the visible sunshine for every day of the year
+def calculate_visibility_raster(silhouette, observer, atlas=None, year=None):
+    raster = VisibilityRaster(year=year)
+    first_day = dt.datetime(raster.year, 1, 1)
+    number_of_days = (dt.datetime(raster.year + 1, 1, 1) - first_day).days
+    dates = [first_day + dt.timedelta(days=i) for i in range(0, number_of_days)]
+
+    u_sun = None
+    if atlas:
+        u_sun = atlas.u_sun[atlas.get_day_indices(dates)]
+    (start, stop, visible, daylight, noon) = \
+        calculate_sun_segments(dates, observer.lat, observer.lon, silhouette, u_sun=u_sun)
+    raster.fill_from_segments(start, stop, visible, daylight, noon)
+    return raster
 
 
 class SunPath:
     
     def __init__(self, stepsize=1, lat=None, lon=None, date=dt.datetime.today()):
-        self.positions = []  # list of tuples (phi, theta)
-        self.visible = []
+        self.times = np.array([])  # greenwich times of the positions (minutes)
+        self.phi = np.array([])  # azimuths of the positions, in ascending order
+        self.theta = np.array([])  # elevations of the positions
+        self.visible = np.array([], dtype=bool)
         self.stepsize = stepsize
         self.lat = lat
         self.lon = lon
@@ -29,34 +431,7 @@ class SunPath:
 
 
     def get_sun_vector(self):
-        # convert to datetime
-        start_date = dt.datetime(2000,1,1)
-
-        # the number of days from 1 Jan 2000
-        n = (self.date - start_date).days
-
-        # mean longitude of the Sun
-        L_deg = (280.460 + 0.9856474 * n) % 360
-
-        # mean anomaly of the Sun
-        g_deg = (357.528 + 0.9856003 * n) % 360
-        g_rad = g_deg * np.pi/180
-
-        # ecliptic longitude
-        lambda_deg = L_deg + 1.915 * np.sin(g_rad) + 0.020 * np.sin(2*g_rad)
-        lambda_rad = lambda_deg * np.pi/180
-
-        # obliquity of the ecliptic
-        eps_deg = 23.439 - 0.0000004 * n
-        eps_rad = eps_deg * np.pi/180
-
-        # Sun's unit vector (in equatorial coordinates) for this day
-        u_sun = np.array([
-                    np.cos(lambda_rad), \
-                    np.cos(eps_rad) * np.sin(lambda_rad), \
-                    np.sin(eps_rad) * np.sin(lambda_rad)\
-                ])
-        return u_sun
+        return get_sun_vectors([self.date])[0]
 
     # cities GPS coordinates
     def get_city_vectors(self, greenwich_time_minutes):
@@ -89,39 +464,45 @@ class SunPath:
 
 
     def calculate_path(self):
-            
         u_sun = self.get_sun_vector()
 
-        for time_minutes in range(0, 1440, self.stepsize):
-            (u_r, u_theta, u_phi) = \
-                self.get_city_vectors(time_minutes)
-
-            # calculate height of the Sun on the sky
-            theta_rad = np.pi/2 - np.arccos( np.dot(u_r, u_sun) )
-            
-            if theta_rad > 0:
-                # calculate projected Sun vector
-                u_sun_projected = u_sun - u_r * np.dot(u_r, u_sun)
-                u_sun_projected = u_sun_projected / \
-                    np.sqrt(np.dot(u_sun_projected, u_sun_projected))
+        times = np.arange(0, 1440, self.stepsize)
+        (phi, theta) = calculate_sun_positions(u_sun, self.lat, self.lon, times)
 
-                # calculate azimuth of Sun
-                phi_rad = np.arccos( np.dot(u_sun_projected, u_theta) )
-                if np.dot(u_sun_projected, u_phi) > 0:
-                    phi_rad *= -1
-
-                self.positions.append( (phi_rad, theta_rad) )
-            
-            self.positions.sort(key=lambda t:t[0])
+        # keep the positions above the horizon, ordered by azimuth
+        daytime = theta > 0
+        order = np.argsort(phi[daytime], kind='mergesort')
+        self.times = times[daytime][order]
+        self.phi = phi[daytime][order]
+        self.theta = theta[daytime][order]
 
     def calculate_visibility(self, sil):
-        cliff_index = 0
-        for p in self.positions:
-            while sil.cliffs[cliff_index].phi < p[0]:
-                cliff_index += 1
-            vis = sil.cliffs[cliff_index].theta_L < p[1]
-            self.visible.append( vis )
-        # return (sum(self.visible), len(self.positions))
+        self.visible = sil.is_visible(self.phi, self.theta)
+
+    # take the positions of this day from the atlas instead of calculating them, unless
+    # the atlas is not accurate enough here
+    def load_from_atlas(self, atlas):
+        if not atlas.covers(self.lat, self.lon):
+            self.calculate_path()
+            return
+        row = atlas.get_day_indices([self.date])[0]
+        daytime = atlas.daytime[row]
+        self.stepsize = atlas.stepsize
+        self.times = atlas.times[row][daytime]
+        self.phi = atlas.phi[row][daytime]
+        self.theta = atlas.theta[row][daytime]
+
+    def load_visibility_from_raster(self, raster):
+        row = raster.get_day_indices([self.date])[0]
+        minutes = (self.times - raster.noon[row] + MINUTES_PER_DAY/2) % MINUTES_PER_DAY
+        self.visible = raster.is_visible(row, minutes)
+
+    # exact intervals of visible sunshine on this day, in greenwich time (minutes)
+    def calculate_visible_intervals(self, sil):
+        (start, stop, visible, daylight, noon) = \
+            calculate_sun_segments([self.date], self.lat, self.lon, sil)
+        intervals = merge_visible_segments(start, stop, visible)[0]
+        return [(noon[0] + t1, noon[0] + t2) for (t1, t2) in intervals]
         
     # def draw(self, ax, color='#ffa700', deg=True, linewidth=3.0):
     #     if deg:
@@ -149,9 +530,13 @@ class SunPath:
         label='',
         text_color='k'):
 
-        path = self.positions
         vis = self.visible
-        L = len(path)
+        L = len(self.phi)
+
+        # project the positions onto the plane of the plot
+        r_arr = np.pi/2 - self.theta
+        x_arr = -r_arr * np.sin(self.phi)
+        y_arr = r_arr * np.cos(self.phi)
 
         i = 0
 
@@ -161,9 +546,8 @@ class SunPath:
                 x_list = []
                 y_list = []
                 while not vis[i]:                
-                    r = np.pi/2 - path[i][1]
-                    x_list.append(-r * np.sin(path[i][0]))
-                    y_list.append(r * np.cos(path[i][0]))
+                    x_list.append(x_arr[i])
+                    y_list.append(y_arr[i])
                     i += 1
                     if not i < L/2:
                         break
@@ -173,9 +557,8 @@ class SunPath:
                 x_list = []
                 y_list = []
                 while vis[i]:                
-                    r = np.pi/2 - path[i][1]
-                    x_list.append(-r * np.sin(path[i][0]))
-                    y_list.append(r * np.cos(path[i][0]))
+                    x_list.append(x_arr[i])
+                    y_list.append(y_arr[i])
                     i += 1
                     if not i < L/2:
                         break
@@ -188,9 +571,8 @@ class SunPath:
                 x_list = []
                 y_list = []
                 while not vis[i]:                
-                    r = np.pi/2 - path[i][1]
-                    x_list.append(-r * np.sin(path[i][0]))
-                    y_list.append(r * np.cos(path[i][0]))
+                    x_list.append(x_arr[i])
+                    y_list.append(y_arr[i])
                     i += 1
                     if not i < L:
                         break
@@ -200,9 +582,8 @@ class SunPath:
                 x_list = []
                 y_list = []
                 while vis[i]:                
-                    r = np.pi/2 - path[i][1]
-                    x_list.append(-r * np.sin(path[i][0]))
-                    y_list.append(r * np.cos(path[i][0]))
+                    x_list.append(x_arr[i])
+                    y_list.append(y_arr[i])
                     i += 1
                     if not i < L:
                         break
@@ -211,9 +592,8 @@ class SunPath:
 
         # label
         x_offset = 0.1
-        r = np.pi/2 - path[0][1]
-        x = -r * np.sin(path[0][0]) + x_offset
-        y = r * np.cos(path[0][0])
+        x = x_arr[0] + x_offset
+        y = y_arr[0]
         ax.text(x, y, label, 
             verticalalignment=u'center', 
             horizontalalignment=u'left',
@@ -236,26 +616,12 @@ class SunPath:
 
 
 class SunSummary:
-    def __init__(self):
-        self.dates = [] # list of datetimes pointing to the Mondays of the weeks
-        self.total_sun = [] # list of floats (minutes)
-        self.morning_sun = [] # list of floats (minutes)
-        self.afternoon_sun = [] # list of floats (minutes)
-        self.sunrise = [] # list of booleans
-        self.sunset = [] # list of booleans
-        self.wakinghours_sun = [] # list of floats (minutes)
-        self.middayhours_sun = [] # list of floats (minutes)
-        
-        # initialize weeks
-        this_year = dt.datetime.today().year
-        one_week = dt.timedelta(weeks=1)
-        d = dt.datetime(this_year, 1, 1)
-        while d.year == this_year:
-            self.dates.append(d)
-            d += one_week
+    def __init__(self, days_between_dates=7):
+        self.days_between_dates = days_between_dates
+        self.clear()
 
     def clear(self):
-        self.dates = [] # list of datetimes pointing to the Mondays of the weeks
+        self.dates = [] # list of datetimes (by default pointing to the Mondays of the weeks)
         self.total_sun = [] # list of floats (minutes)
         self.morning_sun = [] # list of floats (minutes)
         self.afternoon_sun = [] # list of floats (minutes)
@@ -264,35 +630,99 @@ class SunSummary:
         self.wakinghours_sun = [] # list of floats (minutes)
         self.middayhours_sun = [] # list of floats (minutes)
         
-        # initialize weeks
+        # initialize dates
         this_year = dt.datetime.today().year
-        one_week = dt.timedelta(weeks=1)
+        date_step = dt.timedelta(days=self.days_between_dates)
         d = dt.datetime(this_year, 1, 1)
         while d.year == this_year:
             self.dates.append(d)
-            d += one_week
+            d += date_step
 
 
     def collect_summary(self, silhouette, observer, stepsize):
-        for date in self.dates:
-            this_sun = SunPath(lat=observer.lat, lon=observer.lon, date=date, stepsize=stepsize)
-            this_sun.calculate_path()
-            this_sun.calculate_visibility(silhouette)
-
-            total_steps = len(this_sun.positions)
-            self.total_sun.append(total_steps * this_sun.stepsize)
-            self.morning_sun.append(sum(this_sun.visible[:total_steps/2])  * this_sun.stepsize)
-            self.afternoon_sun.append(sum(this_sun.visible[total_steps/2:])  * this_sun.stepsize)
-            sunset_limit_index = int(15 / this_sun.stepsize)
-            self.sunrise.append(any(this_sun.visible[:sunset_limit_index]))
-            self.sunset.append(any(this_sun.visible[-sunset_limit_index:]))
-            
-            six_am_index = total_steps/2 - 360/this_sun.stepsize
-            eight_am_index = total_steps/2 - 240/this_sun.stepsize
-            ten_am_index = total_steps/2 - 120/this_sun.stepsize
-            two_pm_index = total_steps/2 + 120/this_sun.stepsize
-            self.wakinghours_sun.append(sum(this_sun.visible[six_am_index:eight_am_index])  * this_sun.stepsize)
-            self.middayhours_sun.append(sum(this_sun.visible[ten_am_index:two_pm_index])  * this_sun.stepsize)
+        # look up every (date, time step) sample in the city's atlas, or calculate them
+        # for the observer if the atlas is not accurate enough there
+        atlas = get_sun_atlas(observer.city_lat, observer.city_lon, stepsize)
+        if atlas.covers(observer.lat, observer.lon):
+            rows = atlas.get_day_indices(self.dates)
+            phi = atlas.phi[rows]
+            theta = atlas.theta[rows]
+            daytime = atlas.daytime[rows]
+        else:
+            (times, phi, theta, daytime) = \
+                calculate_sun_matrix(self.dates, observer.lat, observer.lon, stepsize)
+        visible = calculate_visibility_matrix(silhouette, phi, theta, daytime)
+
+        # number of daytime steps on each day
+        total_steps = daytime.sum(axis=1)
+        half_steps = total_steps // 2
+        no_steps = np.zeros_like(total_steps)
+        number_of_columns = phi.shape[1]
+
+        def visible_minutes(start, stop):
+            mask = get_slice_mask(start, stop, total_steps, number_of_columns)
+            return ((visible & mask).sum(axis=1) * stepsize).tolist()
+
+        def any_visible(start, stop):
+            mask = get_slice_mask(start, stop, total_steps, number_of_columns)
+            return (visible & mask).any(axis=1).tolist()
+
+        self.total_sun.extend((total_steps * stepsize).tolist())
+        self.morning_sun.extend(visible_minutes(no_steps, half_steps))
+        self.afternoon_sun.extend(visible_minutes(half_steps, total_steps))
+        sunset_limit_index = int(DURATION_OF_SUNRISE_SUNSET // stepsize)
+        self.sunrise.extend(any_visible(no_steps, no_steps + sunset_limit_index))
+        self.sunset.extend(any_visible(no_steps - sunset_limit_index, total_steps))
+
+        six_am_index = half_steps - 360 // stepsize
+        eight_am_index = half_steps - 240 // stepsize
+        ten_am_index = half_steps - 120 // stepsize
+        two_pm_index = half_steps + 120 // stepsize
+        self.wakinghours_sun.extend(visible_minutes(six_am_index, eight_am_index))
+        self.middayhours_sun.extend(visible_minutes(ten_am_index, two_pm_index))
+
+    def collect_exact_summary(self, silhouette, observer, atlas=None):
+        # split each day at the times where the visibility of the Sun may change
+        u_sun = None
+        if atlas:
+            u_sun = atlas.u_sun[atlas.get_day_indices(self.dates)]
+        (start, stop, visible, daylight, noon) = \
+            calculate_sun_segments(self.dates, observer.lat, observer.lon, silhouette, u_sun=u_sun)
+
+        def visible_minutes(window_start, window_stop):
+            return get_visible_minutes(start, stop, visible, window_start, window_stop).tolist()
+
+        # times are measured from solar noon
+        sunrise = -daylight / 2
+        sunset = daylight / 2
+        self.total_sun.extend(daylight.tolist())
+        self.morning_sun.extend(visible_minutes(sunrise, 0))
+        self.afternoon_sun.extend(visible_minutes(0, sunset))
+        self.sunrise.extend([m > 0 for m in 
+            visible_minutes(sunrise, sunrise + DURATION_OF_SUNRISE_SUNSET)])
+        self.sunset.extend([m > 0 for m in 
+            visible_minutes(sunset - DURATION_OF_SUNRISE_SUNSET, sunset)])
+        self.wakinghours_sun.extend(visible_minutes(-360, -240))
+        self.middayhours_sun.extend(visible_minutes(-120, 120))
+
+    def collect_from_raster(self, raster):
+        rows = raster.get_day_indices(self.dates)
+        noon = MINUTES_PER_DAY/2
+        sunrise = noon - raster.daylight[rows] / 2
+        sunset = noon + raster.daylight[rows] / 2
+
+        def visible_minutes(start, stop):
+            return raster.count_minutes(start, stop, rows).tolist()
+
+        self.total_sun.extend(raster.daylight[rows].tolist())
+        self.morning_sun.extend(visible_minutes(0, noon))
+        self.afternoon_sun.extend(visible_minutes(noon, MINUTES_PER_DAY))
+        self.sunrise.extend([m > 0 for m in 
+            visible_minutes(sunrise, sunrise + DURATION_OF_SUNRISE_SUNSET)])
+        self.sunset.extend([m > 0 for m in 
+            visible_minutes(sunset - DURATION_OF_SUNRISE_SUNSET, sunset)])
+        self.wakinghours_sun.extend(visible_minutes(noon - 360, noon - 240))
+        self.middayhours_sun.extend(visible_minutes(noon - 120, noon + 120))
 
     def plot_light(self, ax):
         color_morning = '#ffc469'
@@ -302,8 +732,8 @@ class SunSummary:
         height_of_plot = 600
         dy_ticks = 100
 
-        week_list = np.arange(1, len(self.dates)+1, 1)
-        L = len(week_list)
+        # position of the dates in weeks, starting from 1
+        week_list = np.array([(d - self.dates[0]).days / 7.0 + 1 for d in self.dates])
 
         dates = self.dates
         total = np.array(self.total_sun)
@@ -315,7 +745,7 @@ class SunSummary:
         ax.plot(week_list , -total/2, color='k', linestyle=dashed_style)
         ax.fill_between(week_list , 0, - morning , color=color_morning)
         ax.fill_between(week_list , 0, afternoon, color=color_afternoon)
-        ax.set_xlim([1, L])  
+        ax.set_xlim([1, week_list[-1]])
 
         # find the x positions of the first day of every week
         first_weeks = []
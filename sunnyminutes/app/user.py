@@ -10,8 +10,14 @@ class User:
         self.last_activity_time = dt.datetime.today()
         self.obs = Observer()
         self.sil = Silhouette()
+        self.panorama = Silhouette()
         self.summary = SunSummary()
+        self.raster = None # VisibilityRaster of sil, built for the plots
+        self.silhouette_key = None # (position, window) sil and raster were built for
+        self.geometry = None
+        self.spatial_index = None
         self.buildings = {}
+        self.far_field = {} # Blocks farther away, represented by proxies
         self.building_keys_at_address = []
         self.x_grid = None
         self.y_grid = None
@@ -22,13 +28,7 @@ class User:
         self.last_activity_time = dt.datetime.today()
 
     def get_number_of_floors(self):
-        number_of_floors = 0
-        for key in self.building_keys_at_address:
-            this_floors = int(round(self.buildings[key].z * 1.0/3))
-            if this_floors > number_of_floors:
-                number_of_floors = this_floors
-                
-        return number_of_floors
+        return get_number_of_floors(self.buildings, self.building_keys_at_address)
 
 
 def write_to_log(message):
@@ -2,6 +2,7 @@
 # modules for the web app
 from flask import Flask
 from flask import render_template, request, make_response, session, redirect, url_for
+from flask import g, abort
 from app import app
 import StringIO
 import matplotlib
@@ -12,6 +13,7 @@ from matplotlib.figure import Figure
 from matplotlib import pylab as plt
 import pymysql as mdb
 import datetime as dt
+import json
 
 # my modules
 from buildingmapping import *
@@ -19,6 +21,11 @@ from skyline import *
 from sun import *
 from observer import *
 from user import *
+from buildingstore import *
+from spatialindex import *
+from dbpool import *
+from geocoding import *
+from scoring import *
 
 
 # colors
@@ -34,14 +41,141 @@ SUN_STEPSIZE = 5
 
 SESSION_LIFETIME_IN_SECONDS = 2 * 60
 MAX_NUMBER_OF_ACTIVE_USERS = 100
+SILHOUETTE_CACHE_DIR = None # directory to keep the silhouettes across restarts
+SILHOUETTE_CACHE_VERSION = '1' # to be changed when the buildings in MySQL change
+BUILDING_STORE_DIR = None # directory of a building store, to be used instead of MySQL
+DB_SQLITE_FILE = None # SQLite copy of the database, to be used instead of MySQL
+GEOCODING_CACHE_FILE = None # file to keep the geocoded addresses across restarts
 
 
 write_to_log('Restarting flask server')
 next_user_id = get_next_user_id()
 users = {}
+geocoding_cache = GeocodingCache(cache_file=GEOCODING_CACHE_FILE)
 
+# opened before the workers are forked, so that they share its pages
+building_store = None
+if BUILDING_STORE_DIR:
+    building_store = load_building_store(BUILDING_STORE_DIR)
 
+# the panoramas depend on the buildings and on how far the far field reaches
+silhouette_cache_version = SILHOUETTE_CACHE_VERSION + '_ring' + str(FAR_FIELD_RING_RADIUS)
+if building_store:
+    silhouette_cache_version += '_store' + building_store.get_fingerprint()
+silhouette_cache = SilhouetteCache(cache_dir=SILHOUETTE_CACHE_DIR, version=silhouette_cache_version)
 
+block_proxies = None # far-field proxies of the blocks, loaded on first use
+
+if DB_SQLITE_FILE:
+    db_pool = ConnectionPool(lambda: connect_sqlite(DB_SQLITE_FILE), size=DB_POOL_SIZE)
+else:
+    db_pool = ConnectionPool(
+        lambda: mdb.connect('localhost', 'root', '123', 'Manhattan_buildings'), 
+        size=DB_POOL_SIZE)
+
+
+# connection for the request (checked out from the pool on first use), or the building store
+def get_db_connection():
+    if building_store:
+        return building_store
+    if getattr(g, 'db_connection', None) is None:
+        g.db_connection = db_pool.checkout()
+    return g.db_connection
+
+
+# the far-field proxies of all the blocks of the city, loaded once
+def get_block_proxies(db_connection):
+    global block_proxies
+    if block_proxies is None:
+        block_proxies = load_block_proxies(db_connection)
+    return block_proxies
+
+
+# the atlas of the Sun over the city, with the error bound over the blocks of the grid
+def get_city_sun_atlas(uid):
+    extent = None
+    if users[uid].x_grid is not None:
+        extent = users[uid].obs.get_city_extent(users[uid].x_grid, users[uid].y_grid)
+    return get_sun_atlas(users[uid].obs.city_lat, users[uid].obs.city_lon, SUN_STEPSIZE, extent=extent)
+
+
+@app.teardown_request
+def return_db_connection(exception):
+    db_connection = getattr(g, 'db_connection', None)
+    if db_connection is not None:
+        g.db_connection = None
+        db_pool.checkin(db_connection)
+
+
+# finds the windows of the observer and rebuilds the skyline seen from them
+def update_silhouette(uid):
+    # find windows
+    users[uid].obs.clear_windows()
+    if users[uid].get_number_of_floors() * METERS_PER_FLOOR > users[uid].obs.z:
+        for key in users[uid].building_keys_at_address:
+            users[uid].obs.get_windows(users[uid].buildings[key])
+
+    load_silhouette(uid)
+
+
+# takes the panorama seen from (x, y, z) from the cache, or builds it
+def get_panorama(uid, x, y, z):
+    cache_key = silhouette_cache.get_key(x, y, z)
+    panorama = silhouette_cache.get(cache_key)
+    if panorama is None:
+        # collect the roofs of the visible buildings and add them at once,
+        # reusing the planar geometry if only the floor has changed
+        keys = [key for key in users[uid].buildings if key not in users[uid].building_keys_at_address]
+        (panorama, users[uid].geometry) = build_panorama(users[uid].buildings, keys, 
+            users[uid].far_field, x, y, z, users[uid].geometry)
+        silhouette_cache.put(cache_key, panorama)
+    return panorama
+
+
+# takes the panorama seen from the observer's position, then masks it with the field
+# of view of the closest window; the raster of the previous silhouette is dropped,
+# unless the silhouette is the same
+def load_silhouette(uid):
+    if users[uid].obs.windows:
+        x = users[uid].obs.closest_window.x
+        y = users[uid].obs.closest_window.y
+    else:
+        x = users[uid].obs.x
+        y = users[uid].obs.y
+
+    phi_window = None
+    if users[uid].obs.closest_window:
+        phi_window = users[uid].obs.closest_window.phi
+
+    silhouette_key = (silhouette_cache.get_key(x, y, users[uid].obs.z), phi_window)
+    if silhouette_key != users[uid].silhouette_key:
+        users[uid].raster = None
+        users[uid].silhouette_key = silhouette_key
+
+    panorama = get_panorama(uid, x, y, users[uid].obs.z)
+    users[uid].panorama = panorama
+    if phi_window is None:
+        users[uid].sil = panorama.copy()
+    else:
+        users[uid].sil = panorama.get_window_view(phi_window)
+
+
+# (phi, sun score, sky score) of every window of the observer, all masked from the one
+# panorama at the closest window's position; for the windows on the other facades, a
+# few meters away, this is an approximation
+def get_facade_scores(uid, atlas=None):
+    facade_scores = []
+    for window in users[uid].obs.windows:
+        sil = users[uid].panorama.get_window_view(window.phi)
+        summary = collect_sun_summary(sil, users[uid].obs, atlas=atlas)
+        facade_scores.append((window.phi, get_sun_score(summary), get_sky_score(sil)))
+    return facade_scores
+
+
+# compass direction (e.g. 'SW') of an azimuth measured from South, positive towards West
+def get_compass_direction(phi):
+    directions = ['S', 'SW', 'W', 'NW', 'N', 'NE', 'E', 'SE']
+    return directions[int(round(phi / (np.pi/4))) % 8]
 
 
 @app.after_request
@@ -130,7 +264,7 @@ def zoom():
         return redirect(url_for('index'))
     users[uid].record_as_active()    
 
-    con = mdb.connect('localhost', 'root', '123', 'Manhattan_buildings')
+    con = get_db_connection()
 
     # load basic information about Manhattan
     users[uid].obs.load_basic_geography(con)
@@ -146,7 +280,8 @@ def zoom():
             users[uid].obs.lon = float(match.group(2))
         else:
             address = address + ', Manhattan'
-            users[uid].obs.get_geocoordinates(address, floor=DEFAULT_FLOOR)
+            users[uid].obs.get_geocoordinates(address, floor=DEFAULT_FLOOR,
+                geocoding_cache=geocoding_cache)
     else: 
         address = DEFAULT_ADDRESS
     users[uid].address_placeholder = address
@@ -156,37 +291,43 @@ def zoom():
 
     # get all buildings within the 9 blocks around the observer
     users[uid].buildings.clear()
+    users[uid].geometry = None
     (x_id_list, y_id_list) = users[uid].obs.get_neighboring_block_ids()
 
-    # add buildings on the block
-    buildings_in_observers_block = append_buildings_in_block(con, x_id_list[0], y_id_list[0])
-    if buildings_in_observers_block:
-        users[uid].buildings.update(buildings_in_observers_block)
+    # add buildings on the 9 blocks at once
+    users[uid].buildings.update(load_buildings_in_blocks(con, x_id_list, y_id_list))
+    buildings_in_observers_block = select_buildings_in_block(
+        users[uid].buildings, x_id_list[0], y_id_list[0])
+
     # block is empty, fall back to default address
-    else:
-        users[uid].obs.get_geocoordinates(DEFAULT_ADDRESS, floor=DEFAULT_FLOOR)
+    if not buildings_in_observers_block:
+        users[uid].obs.get_geocoordinates(DEFAULT_ADDRESS, floor=DEFAULT_FLOOR,
+            geocoding_cache=geocoding_cache)
         users[uid].obs.convert_to_cartesian()
-        users[uid].obs.find_my_block(x_grid, y_grid)
+        users[uid].obs.find_my_block(users[uid].x_grid, users[uid].y_grid)
         users[uid].buildings.clear()
         (x_id_list, y_id_list) = users[uid].obs.get_neighboring_block_ids()
-        users[uid].buildings.update(append_buildings_in_block(con, x_id_list[0], y_id_list[0]))
+        users[uid].buildings.update(load_buildings_in_blocks(con, x_id_list, y_id_list))
+        buildings_in_observers_block = select_buildings_in_block(
+            users[uid].buildings, x_id_list[0], y_id_list[0])
+
+    users[uid].spatial_index = SpatialIndex(users[uid].buildings)
+
+    # coarse proxies of the blocks beyond the 9 blocks
+    users[uid].far_field = get_far_field_blocks(
+        get_block_proxies(con), x_id_list[0], y_id_list[0])
 
     # find the buildings the observer is sitting in
     del users[uid].building_keys_at_address[:]
-    users[uid].building_keys_at_address.extend(users[uid].obs.get_my_buildings(users[uid].buildings))
+    users[uid].building_keys_at_address.extend(
+        users[uid].obs.get_my_buildings(buildings_in_observers_block, users[uid].spatial_index))
 
     # find windows
     users[uid].obs.clear_windows()
-    if users[uid].get_number_of_floors() * 3 > users[uid].obs.z:
+    if users[uid].get_number_of_floors() * METERS_PER_FLOOR > users[uid].obs.z:
         for key in users[uid].building_keys_at_address:
             users[uid].obs.get_windows(users[uid].buildings[key])
 
-    # add buildings in neighboring blocks
-    for i in range(1, len(x_id_list)):
-        users[uid].buildings.update(
-            append_buildings_in_block(con, x_id_list[i], y_id_list[i])\
-        )
-
     return render_template('zoom_to_address.html', 
         address_placeholder=users[uid].address_placeholder)
 
@@ -212,11 +353,12 @@ def zoom_after_click():
 
     # find the buildings the observer is sitting in
     del users[uid].building_keys_at_address[:]
-    users[uid].building_keys_at_address.extend(users[uid].obs.get_my_buildings(users[uid].buildings))
+    users[uid].building_keys_at_address.extend(
+        users[uid].obs.get_my_buildings(users[uid].buildings, users[uid].spatial_index))
 
     # find windows
     users[uid].obs.clear_windows()
-    if users[uid].get_number_of_floors() * 3 > users[uid].obs.z:
+    if users[uid].get_number_of_floors() * METERS_PER_FLOOR > users[uid].obs.z:
         for key in users[uid].building_keys_at_address:
             users[uid].obs.get_windows(users[uid].buildings[key])
 
@@ -240,90 +382,19 @@ def show_results():
         floor = DEFAULT_FLOOR
     users[uid].floor_placeholder = str(int(round(users[uid].obs.z / 3)))
 
-    # find windows
-    users[uid].obs.clear_windows()
-    if users[uid].get_number_of_floors() * 3 > users[uid].obs.z:
-        for key in users[uid].building_keys_at_address:
-            users[uid].obs.get_windows(users[uid].buildings[key])
+    update_silhouette(uid)
 
-    # clear skyline
-    users[uid].sil.cliffs = Silhouette().cliffs
-    
-    # add the roof blocking the view towards the back of the window
-    if users[uid].obs.closest_window:
-        phi_window = users[uid].obs.closest_window.phi
-        if phi_window < -np.pi/2:
-            users[uid].sil.add_roof(
-                Roof((
-                    phi_window + np.pi/2, 
-                    phi_window - np.pi/2 + 2*np.pi, 
-                    np.pi/2
-                ))
-            )
-        elif phi_window > np.pi/2:
-            users[uid].sil.add_roof(
-                Roof((
-                    phi_window + np.pi/2 -2*np.pi, 
-                    phi_window - np.pi/2, 
-                    np.pi/2
-                ))
-            )
-        else:
-            users[uid].sil.add_roof(
-                Roof((
-                    -np.pi, 
-                    phi_window - np.pi/2, 
-                    np.pi/2
-                ))
-            )
-            users[uid].sil.add_roof(
-                Roof((
-                    phi_window + np.pi/2, 
-                    np.pi, 
-                    np.pi/2
-                ))
-            )
+    atlas = get_city_sun_atlas(uid)
+    users[uid].summary = collect_sun_summary(users[uid].sil, users[uid].obs, atlas=atlas)
 
-    # add roofs of the buildings to sil
-    for key in users[uid].buildings:
-        if (users[uid].buildings[key].z > users[uid].obs.z) and (key not in users[uid].building_keys_at_address):
-            if users[uid].obs.windows:
-                x = users[uid].obs.closest_window.x
-                y = users[uid].obs.closest_window.y
-            else:
-                x = users[uid].obs.x
-                y = users[uid].obs.y
-            z = users[uid].obs.z
-            roofs = users[uid].buildings[key].get_roofs(x, y, z)
-            for tup in roofs:
-                users[uid].sil.add_roof( Roof(tup) )
-    
-    users[uid].summary.clear()
-    users[uid].summary.collect_summary(users[uid].sil, users[uid].obs, SUN_STEPSIZE)
-
-    # calculate sun score
-    minutes_in_2h = 2*60
-    minutes_in_12h = 12*60
-    minutes_of_total_visible_sun = sum(users[uid].summary.morning_sun)
-    minutes_of_total_visible_sun += sum(users[uid].summary.afternoon_sun)
-    minutes_of_total_visible_sun /= len(users[uid].summary.dates)
-    #minutes_of_waking_sun = sum(summary.wakinghours_sun)
-    #minutes_of_waking_sun /= len(summary.dates)
-    #wakeup_score = 100.0 * minutes_of_waking_sun / minutes_in_2h
-    day_score = 5.0 * minutes_of_total_visible_sun / minutes_in_12h
-    #sun_score = 0.5 * wakeup_score + 0.5 * day_score
-    #wakeup_score = round(wakeup_score, 1)
-    day_score = round(day_score, 1)
-    sun_score = day_score
-    #sun_score = round(sun_score, 1)
+    sun_score = get_sun_score(users[uid].summary)
     sun_icon_file = './static/' + str(round(2 * sun_score, 0) * 0.5) + '_sun.svg'
     
-    # calculate sky score
-    sky_visibility = users[uid].sil.calculate_sky_visibility()
-    sky_score = 5.0 * sky_visibility
-    sky_score = round(sky_score, 1)
+    sky_score = get_sky_score(users[uid].sil)
     sky_icon_file = './static/' + str(round(2 * sky_score, 0) * 0.5) + '_sky.svg'
 
+    # (direction, sun score, sky score) of every facade of the apartment
+    facade_scores = []
 
     if users[uid].obs.closest_window:
         write_to_log(
@@ -335,6 +406,14 @@ def show_results():
             + 'and gets scores: '
             + '(' + str(sun_score) + ', ' + str(sky_score) + ')'
             )
+        for (phi, facade_sun_score, facade_sky_score) in get_facade_scores(uid, atlas=atlas):
+            write_to_log(
+                'Report: user (uid=' + str(uid) + ') '
+                + 'facade facing ' + str(phi * 180/np.pi) + ' from south '
+                + 'gets scores: '
+                + '(' + str(facade_sun_score) + ', ' + str(facade_sky_score) + ')'
+                )
+            facade_scores.append((get_compass_direction(phi), facade_sun_score, facade_sky_score))
     else:
         write_to_log(
             'Report: user (uid=' + str(uid) + ') calculates at '
@@ -352,7 +431,8 @@ def show_results():
         sun_score=sun_score,
         sky_score=sky_score,
         sun_icon_file=sun_icon_file,
-        sky_icon_file=sky_icon_file)
+        sky_icon_file=sky_icon_file,
+        facade_scores=facade_scores)
 
 
 @app.route('/building_zoom')
@@ -371,12 +451,13 @@ def draw_building_zoom():
     fig = plt.figure()
     ax = fig.add_axes([0,0,1,1])
     radius = ZOOM_SIZE/2 * 1.5
-    for key in users[uid].buildings:
-        if users[uid].obs.distance_from_building(users[uid].buildings[key]) < radius:
-            if key not in users[uid].building_keys_at_address:
-                users[uid].buildings[key].plot_footprint(ax, color='k')
-            else:
-                users[uid].buildings[key].plot_footprint(ax, color=COLOR_LIGHTBROWN)
+    if users[uid].spatial_index is None:
+        users[uid].spatial_index = SpatialIndex(users[uid].buildings)
+    for key in users[uid].spatial_index.get_within_radius(users[uid].obs.x, users[uid].obs.y, radius):
+        if key not in users[uid].building_keys_at_address:
+            users[uid].buildings[key].plot_footprint(ax, color='k')
+        else:
+            users[uid].buildings[key].plot_footprint(ax, color=COLOR_LIGHTBROWN)
     users[uid].obs.plot_observers_location(ax, color='r')
     
     L = ZOOM_SIZE/2     # half size of the plotted area in meters
@@ -457,9 +538,12 @@ def draw_inverted_polar_plot():
     plt.clf()   # Clear figure
     plt.close() # Close a figure window
 
+    load_silhouette(uid)
+
     fig = plt.figure()
     ax = fig.add_axes([0,0,1,1])
     users[uid].sil.draw_inverted_polar(ax, color='k')
+    atlas = get_city_sun_atlas(uid)
     this_year = dt.datetime.today().year
     dates_to_plot = [
         dt.datetime(this_year, 6, 21), 
@@ -470,6 +554,9 @@ def draw_inverted_polar_plot():
     afternoon_colors = ['#f98536', 'r', '#f98536']
     labels = ['Jun 21', 'today', 'Dec 22']
     text_colors = ['#f98536', 'r', '#f98536']
+    # the raster of the whole year is only built for the plot, once per silhouette
+    if users[uid].raster is None:
+        users[uid].raster = calculate_visibility_raster(users[uid].sil, users[uid].obs, atlas=atlas)
     for i in range(0, len(dates_to_plot)):
         d = dates_to_plot[i]
         cm = morning_colors[i]
@@ -481,8 +568,8 @@ def draw_inverted_polar_plot():
             lat=users[uid].obs.lat, 
             lon=users[uid].obs.lon, 
             date=d)
-        sun.calculate_path()
-        sun.calculate_visibility(users[uid].sil)
+        sun.load_from_atlas(atlas)
+        sun.load_visibility_from_raster(users[uid].raster)
         sun.draw_inverted_polar(ax, morning_color=cm, afternoon_color=ca, text_color=ct, label=l)  
     
     ax.axis('off')
@@ -503,3 +590,27 @@ def draw_inverted_polar_plot():
     return response 
 
 
+# the statistics of the pools and caches, as JSON; they tell about the server and not
+# about the user, so they are only shown in debug mode (app.debug is set when the app
+# is run, after the routes are registered)
+def make_stats_response(stats):
+    if not app.debug:
+        abort(404)
+    response = make_response(json.dumps(stats))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/db_pool_stats')
+def show_db_pool_stats():
+    return make_stats_response(db_pool.get_stats())
+
+
+@app.route('/silhouette_cache_stats')
+def show_silhouette_cache_stats():
+    return make_stats_response(silhouette_cache.get_stats())
+
+
+@app.route('/geocoding_cache_stats')
+def show_geocoding_cache_stats():
+    return make_stats_response(geocoding_cache.get_stats())
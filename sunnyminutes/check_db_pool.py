@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# checks that the connections of a pool of SQLite connections can be used by any thread,
+# as the connections of the web tier are
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+from dbpool import ConnectionPool, connect_sqlite
+
+
+# checks a connection out and runs a query on it
+def query(pool, results):
+    try:
+        with pool.connection() as db_connection:
+            cur = db_connection.cursor()
+            cur.execute('SELECT COUNT(*) FROM buildings')
+            results.append(cur.fetchone()[0])
+    except Exception as e:
+        results.append(e)
+
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'buildings.sqlite')
+        db_connection = connect_sqlite(path)
+        db_connection.execute('CREATE TABLE buildings (id INTEGER)')
+        db_connection.execute('INSERT INTO buildings VALUES (1)')
+        db_connection.commit()
+        db_connection.close()
+
+        # with one connection in the pool, the other thread gets the one made by this one
+        # (which is kept alive, as a finished thread's id may be given to the next one)
+        pool = ConnectionPool(lambda: connect_sqlite(path), size=1)
+        results = []
+        query(pool, results)
+        thread = threading.Thread(target=query, args=(pool, results))
+        thread.start()
+        thread.join()
+        stats = pool.get_stats()
+        pool.close()
+    finally:
+        shutil.rmtree(directory)
+
+    # a connection refused by the other thread would fail its health check and be replaced
+    print results, stats
+    if results != [1, 1] or stats['created'] != 1 or stats['discarded'] != 0:
+        print 'FAILED'
+        sys.exit(1)
+    print 'OK'
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# exports the Manhattan_buildings tables (from MySQL, a SQLite file or a mysqldump file)
+# to a building store directory, to be set as BUILDING_STORE_DIR in app/views.py
+import os
+import sys
+import sqlite3
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+from buildingexport import export_building_store, load_sql_dump
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the buildings to a building store.')
+    parser.add_argument('output', help='directory of the building store')
+    parser.add_argument('--sqlite', help='read from a SQLite file instead of MySQL')
+    parser.add_argument('--sql-dump', help='read from a mysqldump file instead of MySQL')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='123')
+    parser.add_argument('--database', default='Manhattan_buildings')
+    args = parser.parse_args()
+
+    if args.sqlite:
+        con = sqlite3.connect(args.sqlite)
+    elif args.sql_dump:
+        con = load_sql_dump(args.sql_dump)
+    else:
+        import pymysql as mdb
+        con = mdb.connect(args.host, args.user, args.password, args.database)
+
+    store = export_building_store(con)
+    store.save(args.output)
+    print 'Exported ' + str(store.get_number_of_buildings()) + ' buildings to ' + args.output